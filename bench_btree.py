@@ -0,0 +1,27 @@
+import random
+from time import perf_counter
+from db.btree import BTree
+
+# Compares building a BTree one insert at a time against bulk loading it.
+# Run with `python bench_btree.py`
+
+def bench(count, order=15):
+    keys = random.sample(range(1, count * 10), count)
+    pairs = [(key, index) for index, key in enumerate(keys)]
+
+    start = perf_counter()
+    tree = BTree(order)
+    for key, value in pairs:
+        tree.insert(key, value)
+    inserts = perf_counter() - start
+
+    start = perf_counter()
+    tree = BTree(order)
+    tree.bulk_load(pairs)
+    bulk = perf_counter() - start
+
+    print(f'{count} keys: insert {inserts:.2f}s, bulk load {bulk:.2f}s ({inserts / bulk:.1f}x faster)')
+
+if __name__ == '__main__':
+    for count in [10000, 100000, 250000]:
+        bench(count)
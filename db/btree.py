@@ -1,7 +1,11 @@
 import os
-from math import floor
-from utils import split, openfile
-from .persistence import Uint32PairPersist
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from math import floor, ceil
+from .cache import LRUCache
+from .persistence import FileHeader, HEADER, WRITE_BUFFER, open_pooled
 
 # Inserts a value in the first empty space found,
 # or in the first position that would keep the array
@@ -201,28 +205,24 @@ class BTreeNode:
         # [0:-1] to discard the extra slot that is allocated
         return self.data[:-1]
 
-    # Returns all nodes of the tree, including null links
-    # (except for tree nodes, we don't return any of their children)
-    def bfs_with_nulls(self):
-        queue = [self]
-        discovered = [self]
+    # Returns all nodes of the subtree, level by level
+    def bfs(self):
+        queue = deque([self])
 
         while len(queue) > 0:
-            node = queue.pop(0)
+            node = queue.popleft()
             yield node
 
-            if node == None:
-                continue
-
             if not node.leaf:
                 # [0:-1] to discard the extra slot that is allocated
                 for child in node.children[0:-1]:
-                    if child == None:
-                        queue.append(child)
-                    elif child not in discovered:
-                        discovered.append(child)
+                    if child != None:
                         queue.append(child)
 
+    def get_children(self):
+        # [0:-1] to discard the extra slot that is allocated
+        return [child for child in self.children[0:-1] if child != None]
+
     def __repr__(self):
         data = []
 
@@ -248,94 +248,611 @@ class BTree:
     def insert(self, key, value):
         self.root.insert((key, value))
 
-    def bfs_with_nulls(self):
-        return self.root.bfs_with_nulls()
+    # Replaces the contents of the tree with (key, value) pairs, building it
+    # bottom-up: the pairs are sorted and packed into full leaves, and each
+    # level is built on top of the previous one in a single pass
+    def bulk_load(self, pairs):
+        items = sorted(pairs, key=lambda pair: pair[0])
+
+        # Start from the leaves, which have no children
+        nodes, items = self.build_level(items, None)
+
+        while len(nodes) > 1:
+            nodes, items = self.build_level(items, nodes)
+
+        self.root = nodes[0] if len(nodes) > 0 else BTreeNode(self)
+
+    # Packs sorted items into as few nodes as possible, leaving one item
+    # between each pair of nodes to go up as their separator.
+    # Returns the (nodes, separators). The nodes get `children` in order,
+    # one more than their number of items
+    def build_level(self, items, children):
+        capacity = self.order - 1
+
+        # Every node but the last is followed by a separator
+        count = max(1, ceil((len(items) + 1) / (capacity + 1)))
+        # Spread the items evenly, so no node is left under half full
+        size, extra = divmod(len(items) - (count - 1), count)
+
+        nodes = []
+        separators = []
+        position = 0
+        child = 0
+
+        for i in range(count):
+            length = size + (1 if i < extra else 0)
+
+            data = items[position:position + length]
+            position += length
+
+            if children == None:
+                nodes.append(BTreeNode(self, data))
+            else:
+                nodes.append(BTreeNode(self, data, children[child:child + length + 1], False))
+                child += length + 1
+
+            if i < count - 1:
+                separators.append(items[position])
+                position += 1
+
+        return nodes, separators
+
+    def bfs(self):
+        return self.root.bfs()
 
 
 class PersistentBTree:
-    # Stores a BTree in a file, representing it as an array:
-    # The n-th (0-based) child of the i-th (0-based) node is the
-    # order * i + n + 1 element of the array
-    def __init__(self, order, filename, persist):
+    # Stores a BTree in a file, one node per page. Pages are numbered
+    # from 0 (the root), and each of them holds, as columns:
+    # - how many data points the node has
+    # - order - 1 slots for the keys of its data points
+    # - order - 1 slots for their values
+    # - order slots for the page numbers of its children (0 when there is
+    #   no child, since the root is never a child)
+    # Keys and values are stored as `key_type` and `value_type` (array
+    # typecodes), so a node can be searched right on the bytes of its page.
+    # The header counts how many pages we have, its first extra slot how
+    # many keys, and the second one the first page of the free list (0 when
+    # empty). Freed pages hold the next free page where their count was.
+    # The top `pinned_levels` levels are kept in memory once they are
+    # first needed, and the nodes below them go through a small LRU
+    MAGIC = b'BGGB'
+    VERSION = 3
+
+    PINNED_LEVELS = 4
+    NODE_CACHE = 256
+
+    def __init__(self, order, filename, key_type='I', value_type='I', pool=None, pinned_levels=PINNED_LEVELS, node_cache=NODE_CACHE):
         self.order = order
-        self.persist = persist
+        self.key_type = key_type
+        self.value_type = value_type
+
+        self.pinned_levels = pinned_levels
+        self.pinned = None
+        self.pinned_hits = 0
+        self.nodes = LRUCache(node_cache)
+
+        # Where each column of a page starts
+        self.keys_start = 4
+        self.values_start = self.keys_start + array(key_type).itemsize * (order - 1)
+        self.children_start = self.values_start + array(value_type).itemsize * (order - 1)
+        self.page_size = self.children_start + array('I').itemsize * order
+
+        self.file = open_pooled(filename, pool)
+        self.header = FileHeader(self.file, self.MAGIC, self.VERSION, self.page_size)
+
+    # Writes a tree to the file, stamping it with a new generation.
+    # Nodes are written as they are visited, level by level: since children
+    # are numbered in the order they're found, a node already knows the
+    # pages its children will end up in
+    def dump(self, tree, generation=None):
+        assert tree.order == self.order
 
-        self.file = openfile(filename)
-        self.file.seek(0, 2)
-        self.filesize = self.file.tell()
+        self.header.reset(generation)
+        self.file.seek(HEADER.size)
+        self.forget()
 
+        buffer = bytearray()
+        # Page of the next node we find
+        next_page = 1
+        keys = 0
 
-    def dump(self, tree):
-        assert tree.order == self.order
+        for node in tree.bfs():
+            data = [d for d in node.get_data() if d != None]
+            padding = [0] * (self.order - 1 - len(data))
+            children = [0] * self.order
+
+            if not node.leaf:
+                for i in range(len(node.get_children())):
+                    children[i] = next_page
+                    next_page += 1
 
-        # size of data point * number of data points
-        node_size = self.persist.data_size * (self.order - 1)
+            buffer += struct.pack('I', len(data))
+            buffer += array(self.key_type, [d[0] for d in data] + padding).tobytes()
+            buffer += array(self.value_type, [d[1] for d in data] + padding).tobytes()
+            buffer += array('I', children).tobytes()
 
-        # Start at the begining (duh)
-        self.file.seek(0)
-        self.filesize = 0
+            keys += len(data)
+            self.header.count += 1
 
-        for node in tree.bfs_with_nulls():
-            self.filesize += node_size
-            if node == None:
-                self.file.write(self.persist.to_bytes(None) * (self.order - 1))
-            else:
-                for data_point in node.get_data():
-                    self.file.write(self.persist.to_bytes(data_point))
+            if len(buffer) >= WRITE_BUFFER:
+                self.file.write(buffer)
+                buffer = bytearray()
 
-        # Discard any leftover
-        self.file.truncate()
+        self.file.write(buffer)
+
+        self.header.extra[0] = keys
+        self.header.write()
 
     def find(self, key):
-        node_number = 0
-        node = self.load_node(0)
+        node = self.get_node(0)
 
         while node != None:
-            i = 0
+            keys, values, children = node
 
-            for data in node:
-                # We have walked all the array and not found a single key
-                # greater than ours, dive to the rightmost child (which i points to)
-                if data == None:
-                    break
+            # i points to the first key not smaller than ours, which is
+            # also the child to dive into when it's not our key
+            i = bisect_left(keys, key)
 
-                # If our key is smaller than one on this node, we must
-                # dive into the left child of it (which i points to)
-                if key < data[0]:
-                    break
+            if i < len(keys) and keys[i] == key:
+                return values[i]
+
+            if children[i] == 0:
+                # We're at a leaf
+                return None
+
+            node = self.get_node(children[i])
+
+        return None
+
+    # Same as find, for several keys at once. Keys are sorted and looked up
+    # together, so every node is read once for all the keys that go
+    # through it. Values come back in the order of `keys`
+    def find_many(self, keys):
+        res = [None] * len(keys)
+
+        if self.count() > 0:
+            pending = sorted((key, i) for i, key in enumerate(keys))
+            self.find_sorted(0, pending, res)
+
+        return res
 
-                # Found the key
-                if data[0] == key:
-                    return data[1]
+    # Looks up the sorted (key, position) pairs on the subtree at `page`,
+    # storing the values found on res
+    def find_sorted(self, page, pending, res):
+        keys, values, children = self.get_node(page)
+        # Keys waiting for each child of this node
+        below = {}
+        i = 0
 
+        for key, position in pending:
+            while i < len(keys) and keys[i] < key:
                 i += 1
 
-            node_number = self.child_of(node_number, i)
-            node = self.load_node(node_number)
+            if i < len(keys) and keys[i] == key:
+                res[position] = values[i]
+            elif children[i] != 0:
+                below.setdefault(i, []).append((key, position))
 
-        return None
+        for i in below:
+            self.find_sorted(children[i], below[i], res)
 
-    def child_of(self, parent, child):
-        return self.order * parent + child + 1
+    # Returns a cursor over the tree, see BTreeCursor
+    def cursor(self, reverse=False):
+        return BTreeCursor(self, reverse)
 
-    # Loads the i-th (0-based) node of the tree
-    def load_node(self, i):
-        location = i * (self.persist.data_size * (self.order - 1))
+    # Yields the (key, value) pairs with lo <= key <= hi in key order,
+    # or from the greatest key down when `reverse` is set.
+    # Either bound can be None to leave that side open
+    def range(self, lo=None, hi=None, reverse=False):
+        cursor = self.cursor(reverse)
+        cursor.seek(hi if reverse else lo)
 
-        if location >= self.filesize:
-            return None
+        while True:
+            item = cursor.next()
+
+            if item == None:
+                return
+
+            if reverse and lo != None and item[0] < lo:
+                return
+
+            if not reverse and hi != None and item[0] > hi:
+                return
+
+            yield item
+
+    # Returns the i-th (0-based) node of the tree, from memory when it is
+    # pinned or cached, and from the file otherwise
+    def get_node(self, i):
+        if self.pinned == None:
+            self.pin()
+
+        if i in self.pinned:
+            self.pinned_hits += 1
+            return self.pinned[i]
+
+        node = self.nodes.get(i)
+        if node == None:
+            node = self.load_node(i)
+            if node != None:
+                self.nodes.put(i, node)
+
+        return node
+
+    # Loads the top levels of the tree. Pages are numbered level by
+    # level, so each level is the run of pages its parents point to
+    def pin(self):
+        self.pinned = {}
+
+        level = [0] if self.header.count > 0 else []
+        for _ in range(self.pinned_levels):
+            below = []
+
+            for i in level:
+                node = self.load_node(i)
+                self.pinned[i] = node
+                below += [c for c in node[2] if c != 0]
 
-        self.file.seek(location)
+            level = below
 
-        bts = self.file.read(self.persist.data_size * (self.order - 1))
+    # Drops every node kept in memory, as they're stale once the file changes
+    def forget(self):
+        self.pinned = None
+        self.nodes.clear()
 
-        data = [self.persist.from_bytes(b) for b in split(bts, self.persist.data_size)]
+    def stats(self):
+        res = self.nodes.stats()
+        res['pinned'] = len(self.pinned) if self.pinned != None else 0
+        res['pinned_hits'] = self.pinned_hits
 
-        # Check if there are no data points in this node
-        if data[0] == None:
+        return res
+
+    # Loads the i-th (0-based) page of the tree, returning the node's
+    # (keys, values, children)
+    def load_node(self, i):
+        if i >= self.header.count:
             return None
 
-        return data
+        self.file.seek(HEADER.size + i * self.page_size)
+
+        return self.decode_page(self.file.read(self.page_size))
+
+    # Nothing is decoded: keys, values and children are views on the
+    # bytes of the page, and one of them is only unpacked when read
+    def decode_page(self, page):
+        page = memoryview(page)
+
+        count = struct.unpack_from('I', page)[0]
+        keys = page[self.keys_start:self.values_start].cast(self.key_type)[:count]
+        values = page[self.values_start:self.children_start].cast(self.value_type)[:count]
+        children = page[self.children_start:].cast('I')
+
+        return keys, values, children
+
+    # Inserts a key, or replaces its value when it is already there.
+    # Only the pages on the path to the key are written, plus the ones
+    # created when full nodes are split on the way back up
+    def insert(self, key, value):
+        if self.header.count == 0:
+            self.write_node(self.allocate(), [], [], [])
+            self.forget()
+
+        path = self.path_to(key)
+        page, i = path.pop()
+        keys, values, children = self.read_node(page)
+
+        if i < len(keys) and keys[i] == key:
+            values[i] = value
+            self.write_node(page, keys, values, children)
+            return
+
+        keys.insert(i, key)
+        values.insert(i, value)
+        self.header.extra[0] += 1
+
+        while len(keys) > self.order - 1:
+            middle = len(keys) // 2
+
+            if page == 0:
+                # The root always stays on the first page, so both halves
+                # move to new pages and the root keeps just the middle key
+                left = self.allocate()
+                right = self.allocate()
+                self.write_node(left, keys[:middle], values[:middle], children[:middle + 1])
+                self.write_node(right, keys[middle + 1:], values[middle + 1:], children[middle + 1:])
+
+                keys, values, children = [keys[middle]], [values[middle]], [left, right]
+                break
+
+            # The right half moves to a new page, and the middle key goes up
+            right = self.allocate()
+            self.write_node(right, keys[middle + 1:], values[middle + 1:], children[middle + 1:])
+            self.write_node(page, keys[:middle], values[:middle], children[:middle + 1])
+            up = keys[middle], values[middle]
+
+            page, i = path.pop()
+            keys, values, children = self.read_node(page)
+            keys.insert(i, up[0])
+            values.insert(i, up[1])
+            children.insert(i + 1, right)
+
+        self.write_node(page, keys, values, children)
+        self.header.write()
+
+    # Deletes a key, returning whether it was there. Nodes left with too
+    # few keys borrow from a sibling or are merged with it, and merged
+    # pages go to the free list
+    def delete(self, key):
+        if self.header.count == 0:
+            return False
+
+        path = self.path_to(key)
+        page, i = path[-1]
+        keys, values, children = self.read_node(page)
+
+        if i >= len(keys) or keys[i] != key:
+            return False
+
+        if len(children) > 0:
+            # Take the greatest key of the left subtree, which is on a
+            # leaf, to replace ours
+            leaf = children[i]
+            while True:
+                leaf_keys, leaf_values, leaf_children = self.read_node(leaf)
+                if len(leaf_children) == 0:
+                    break
+
+                path.append((leaf, len(leaf_keys)))
+                leaf = leaf_children[-1]
+
+            path.append((leaf, len(leaf_keys) - 1))
+
+            keys[i], values[i] = leaf_keys[-1], leaf_values[-1]
+            self.write_node(page, keys, values, children)
+
+            page, keys, values, children = leaf, leaf_keys, leaf_values, leaf_children
+            i = len(keys) - 1
+
+        del keys[i]
+        del values[i]
+        self.header.extra[0] -= 1
+
+        self.rebalance(path, keys, values, children)
+        self.header.write()
+
+        return True
+
+    # Writes the last node of the path, fixing it and its ancestors when
+    # they're left with too few keys
+    def rebalance(self, path, keys, values, children):
+        minimum = ceil(self.order / 2) - 1
+        page, _ = path.pop()
+
+        while page != 0 and len(keys) < minimum:
+            parent, i = path.pop()
+            parent_keys, parent_values, parent_children = self.read_node(parent)
+
+            if i > 0:
+                left = parent_children[i - 1]
+                left_keys, left_values, left_children = self.read_node(left)
+
+                if len(left_keys) > minimum:
+                    # Rotate the last key of the left sibling through the parent
+                    keys.insert(0, parent_keys[i - 1])
+                    values.insert(0, parent_values[i - 1])
+                    if len(left_children) > 0:
+                        children.insert(0, left_children.pop())
+                    parent_keys[i - 1], parent_values[i - 1] = left_keys.pop(), left_values.pop()
+
+                    self.write_node(left, left_keys, left_values, left_children)
+                    self.write_node(parent, parent_keys, parent_values, parent_children)
+                    break
+
+            if i < len(parent_children) - 1:
+                right = parent_children[i + 1]
+                right_keys, right_values, right_children = self.read_node(right)
+
+                if len(right_keys) > minimum:
+                    # Rotate the first key of the right sibling through the parent
+                    keys.append(parent_keys[i])
+                    values.append(parent_values[i])
+                    if len(right_children) > 0:
+                        children.append(right_children.pop(0))
+                    parent_keys[i], parent_values[i] = right_keys.pop(0), right_values.pop(0)
+
+                    self.write_node(right, right_keys, right_values, right_children)
+                    self.write_node(parent, parent_keys, parent_values, parent_children)
+                    break
+
+            # No sibling can lend a key, merge with one of them along with
+            # the parent key between us
+            if i > 0:
+                self.write_node(
+                    left,
+                    left_keys + [parent_keys[i - 1]] + keys,
+                    left_values + [parent_values[i - 1]] + values,
+                    left_children + children)
+                self.free(page)
+
+                del parent_keys[i - 1]
+                del parent_values[i - 1]
+                del parent_children[i]
+            else:
+                self.write_node(
+                    page,
+                    keys + [parent_keys[i]] + right_keys,
+                    values + [parent_values[i]] + right_values,
+                    children + right_children)
+                self.free(right)
+
+                del parent_keys[i]
+                del parent_values[i]
+                del parent_children[i + 1]
+
+            page, keys, values, children = parent, parent_keys, parent_values, parent_children
+
+        if page == 0 and len(keys) == 0 and len(children) > 0:
+            # The root lost its last key, its only child takes its place
+            child = children[0]
+            keys, values, children = self.read_node(child)
+            self.free(child)
+
+        self.write_node(page, keys, values, children)
+
+    # Returns the (page, i) pairs visited looking for a key, i being the
+    # position of the key on that page, or the child we went down
+    def path_to(self, key):
+        path = []
+        page = 0
+
+        while True:
+            keys, values, children = self.get_node(page)
+            i = bisect_left(keys, key)
+            path.append((page, i))
+
+            if (i < len(keys) and keys[i] == key) or children[i] == 0:
+                return path
+
+            page = children[i]
+
+    # Returns a node as lists that can be changed and written back with
+    # write_node. Leaves have no children
+    def read_node(self, page):
+        keys, values, children = self.get_node(page)
+        children = list(children[:len(keys) + 1]) if children[0] != 0 else []
+
+        return list(keys), list(values), children
+
+    def write_node(self, page, keys, values, children):
+        padding = [0] * (self.order - 1 - len(keys))
+
+        bts = bytearray(struct.pack('I', len(keys)))
+        bts += array(self.key_type, keys + padding).tobytes()
+        bts += array(self.value_type, values + padding).tobytes()
+        bts += array('I', children + [0] * (self.order - len(children))).tobytes()
+
+        self.file.seek(HEADER.size + page * self.page_size)
+        self.file.write(bts)
+
+        # Keep the copies in memory up to date
+        if self.pinned != None and page in self.pinned:
+            self.pinned[page] = self.decode_page(bytes(bts))
+        else:
+            self.nodes.remove(page)
+
+    # Returns the number of a page we can write a new node to, reusing
+    # freed pages first
+    def allocate(self):
+        page = self.header.extra[1]
+
+        if page != 0:
+            self.file.seek(HEADER.size + page * self.page_size)
+            self.header.extra[1] = struct.unpack('I', self.file.read(4))[0]
+        else:
+            page = self.header.count
+            self.header.count += 1
+
+        return page
+
+    # Puts a page at the start of the free list
+    def free(self, page):
+        self.file.seek(HEADER.size + page * self.page_size)
+        self.file.write(struct.pack('I', self.header.extra[1]))
+        self.header.extra[1] = page
+
+        if self.pinned != None:
+            self.pinned.pop(page, None)
+        self.nodes.remove(page)
+
+    # Returns how many pages we have
+    def count(self):
+        return self.header.count
+
+    # Returns how many keys we have
+    def keys(self):
+        return self.header.extra[0]
 
     def close(self):
         self.file.close()
+
+
+class BTreeCursor:
+    # Walks a PersistentBTree in key order, or in reverse order when
+    # `reverse` is set. Since data points live in every node and not just
+    # the leaves, the cursor keeps the path from the root to where it is:
+    # a stack of [keys, values, children, i] frames. Going forward, i is the
+    # next data point of that node to return, and going backwards, how many
+    # of them are still to be returned
+    def __init__(self, tree, reverse=False):
+        self.tree = tree
+        self.reverse = reverse
+        self.stack = []
+
+    # Places the cursor right before the smallest key >= key (the greatest
+    # key <= key going backwards), or the first key when it is None
+    def seek(self, key=None):
+        self.stack = []
+        node = self.tree.get_node(0) if self.tree.count() > 0 else None
+
+        while node != None:
+            keys, values, children = node
+
+            if self.reverse:
+                i = bisect_right(keys, key) if key != None else len(keys)
+                # Found the key: everything on its right child is greater
+                found = i > 0 and keys[i - 1] == key
+            else:
+                i = bisect_left(keys, key) if key != None else 0
+                # Found the key: everything on its left child is smaller
+                found = i < len(keys) and keys[i] == key
+
+            self.stack.append([keys, values, children, i])
+
+            if found:
+                return
+
+            node = self.tree.get_node(children[i]) if children[i] != 0 else None
+
+    # Returns the next (key, value) pair, or None when we're past the
+    # last one
+    def next(self):
+        while len(self.stack) > 0:
+            frame = self.stack[-1]
+            keys, values, children, i = frame
+
+            if self.reverse:
+                if i == 0:
+                    self.stack.pop()
+                    continue
+
+                frame[3] -= 1
+                i -= 1
+
+                # Everything on the left child comes before the previous
+                # data point of this node
+                child = children[i]
+                while child != 0:
+                    node = self.tree.get_node(child)
+                    self.stack.append([*node, len(node[0])])
+                    child = node[2][len(node[0])]
+
+                return keys[i], values[i]
+
+            if i >= len(keys):
+                self.stack.pop()
+                continue
+
+            frame[3] += 1
+
+            # Everything on the right child comes before the next data
+            # point of this node
+            child = children[i + 1]
+            while child != 0:
+                node = self.tree.get_node(child)
+                self.stack.append([*node, 0])
+                child = node[2][0]
+
+            return keys[i], values[i]
+
+        return None
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+from utils import openfile
+
+class LRUCache():
+    # Keeps up to `capacity` items, evicting the least recently used one
+    # when a new item doesn't fit
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the cached item, or None if it is not cached
+    def get(self, key):
+        if key not in self.items:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.items.move_to_end(key)
+
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items = OrderedDict()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.items),
+        }
+
+
+class BufferPool():
+    # Pages of files, shared by every file opened through the pool and
+    # evicted in LRU order once they don't fit in `budget` bytes.
+    # Files opened with `open` read through the pool, and their writes
+    # invalidate the pages they touch
+    def __init__(self, budget=32 * 1024 * 1024, page_size=4096):
+        self.page_size = page_size
+        self.pages = LRUCache(max(1, budget // page_size))
+
+    def open(self, filename):
+        return PooledFile(self, filename)
+
+    # Reads `length` bytes at `offset` of a PooledFile, going to
+    # the disk only for the pages we don't have
+    def read(self, file, offset, length):
+        size = self.page_size
+        end = min(offset + length, file.size)
+
+        if end <= offset:
+            return b''
+
+        first = offset // size
+        last = (end - 1) // size
+
+        pages = [self.pages.get((file.name, n)) for n in range(first, last + 1)]
+
+        i = 0
+        while i < len(pages):
+            if pages[i] != None:
+                i += 1
+                continue
+
+            # Read all the missing pages in a row at once
+            j = i
+            while j < len(pages) and pages[j] == None:
+                j += 1
+
+            file.raw.seek((first + i) * size)
+            data = file.raw.read((j - i) * size)
+
+            for k in range(i, j):
+                pages[k] = data[(k - i) * size:(k - i + 1) * size]
+                self.pages.put((file.name, first + k), pages[k])
+
+            i = j
+
+        start = offset - first * size
+
+        return b''.join(pages)[start:start + end - offset]
+
+    # Drops the pages of a file from `start` to `end` (in bytes). Without
+    # an end, drops every page from `start` on
+    def invalidate(self, file, start, end=None):
+        first = start // self.page_size
+
+        if end != None and end - start < len(self.pages.items) * self.page_size:
+            for n in range(first, (end - 1) // self.page_size + 1):
+                self.pages.remove((file.name, n))
+            return
+
+        for key in list(self.pages.items):
+            if key[0] == file.name and key[1] >= first and (end == None or key[1] * self.page_size < end):
+                self.pages.remove(key)
+
+    def stats(self):
+        return self.pages.stats()
+
+class PooledFile():
+    # A file that reads through a BufferPool. Supports the parts of
+    # the file interface used by the database
+    def __init__(self, pool, filename):
+        self.pool = pool
+        self.raw = openfile(filename)
+        self.name = filename
+        self.pos = 0
+
+        self.raw.seek(0, 2)
+        self.size = self.raw.tell()
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.pos = offset
+        elif whence == 1:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, length):
+        data = self.pool.read(self, self.pos, length)
+        self.pos += len(data)
+
+        return data
+
+    def write(self, data):
+        end = self.pos + len(data)
+
+        self.raw.seek(self.pos)
+        self.raw.write(data)
+
+        if end > self.size:
+            # Pages past the end of the file were cached short, or not at all
+            self.pool.invalidate(self, min(self.pos, self.size), end)
+            self.size = end
+        else:
+            self.pool.invalidate(self, self.pos, end)
+
+        self.pos = end
+
+        return len(data)
+
+    def truncate(self):
+        self.raw.seek(self.pos)
+        self.raw.truncate()
+
+        self.pool.invalidate(self, min(self.pos, self.size))
+        self.size = self.pos
+
+    def flush(self):
+        self.raw.flush()
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def close(self):
+        self.pool.invalidate(self, 0)
+        self.raw.close()
@@ -0,0 +1,136 @@
+import operator
+from array import array
+from utils import openfile
+from .persistence import FileHeader, IncompatibleFileError, HEADER
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Comparisons that can be used in filters. They work both on single
+# values and, element by element, on NumPy arrays
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '>=': operator.ge,
+    '>': operator.gt,
+}
+
+class ColumnStore():
+    # Stores numeric attributes of a document one column at a time: each
+    # of them is a contiguous array of uint32, where the n-th value belongs
+    # to the n-th row of the document's table. This lets us filter on them
+    # without loading a single document.
+    # Columns are memory-mapped as NumPy arrays when NumPy is available,
+    # and read into plain arrays otherwise
+    MAGIC = b'BGGC'
+    VERSION = 1
+
+    def __init__(self, filename, columns):
+        self.columns = columns
+        self.filenames = {}
+        self.files = {}
+        self.headers = {}
+        # Loaded columns
+        self.arrays = {}
+
+        try:
+            for column in columns:
+                self.filenames[column] = f'{filename}.{column}.column'
+                self.files[column] = openfile(self.filenames[column])
+                self.headers[column] = FileHeader(self.files[column], self.MAGIC, self.VERSION, 4)
+        except IncompatibleFileError:
+            # Close the columns opened so far
+            for file in self.files.values():
+                file.close()
+            raise
+
+    # Writes the columns of every item, stamping them with a new generation
+    def build(self, data, generation=None):
+        # Drop the maps before their files get truncated
+        self.arrays = {}
+
+        for column in self.columns:
+            values = array('I', (item[column] for item in data))
+
+            header = self.headers[column]
+            header.reset(generation)
+
+            self.files[column].seek(HEADER.size)
+            self.files[column].write(values.tobytes())
+            self.files[column].flush()
+
+            header.count = len(values)
+            header.write()
+
+    # Appends the columns of one more item, returning its row
+    def insert(self, item):
+        # Drop the maps, which don't cover the new row
+        self.arrays = {}
+        row = self.count()
+
+        for column in self.columns:
+            header = self.headers[column]
+
+            self.files[column].seek(HEADER.size + row * 4)
+            self.files[column].write(array('I', [item[column]]).tobytes())
+            self.files[column].flush()
+
+            header.count = row + 1
+            header.write()
+
+        return row
+
+    # Returns how many rows we have
+    def count(self):
+        return self.headers[self.columns[0]].count
+
+    # Returns all values of a column
+    def column(self, column):
+        if column not in self.arrays:
+            count = self.headers[column].count
+
+            if numpy != None:
+                if count == 0:
+                    # Empty files can't be mapped
+                    values = numpy.zeros(0, dtype=numpy.uint32)
+                else:
+                    self.files[column].flush()
+                    values = numpy.memmap(self.filenames[column], dtype=numpy.uint32, mode='r', offset=HEADER.size, shape=(count,))
+            else:
+                values = array('I')
+                self.files[column].seek(HEADER.size)
+                values.frombytes(self.files[column].read(count * values.itemsize))
+
+            self.arrays[column] = values
+
+        return self.arrays[column]
+
+    # Returns the (0-based) rows matching every condition. Conditions are
+    # (column, operator, value) tuples, with operators from OPERATORS,
+    # such as ('max_playtime', '<=', 60)
+    def filter(self, conditions):
+        if numpy != None:
+            mask = numpy.ones(self.count(), dtype=bool)
+
+            for column, op, value in conditions:
+                mask &= OPERATORS[op](self.column(column), value)
+
+            return numpy.flatnonzero(mask).tolist()
+
+        rows = range(self.count())
+
+        for column, op, value in conditions:
+            values = self.column(column)
+            compare = OPERATORS[op]
+            rows = [row for row in rows if compare(values[row], value)]
+
+        return list(rows)
+
+    def close(self):
+        self.arrays = {}
+
+        for column in self.columns:
+            self.files[column].close()
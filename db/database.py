@@ -1,88 +1,221 @@
 import os
 import re
-from hashlib import md5
-from utils import tokenize
+from collections import Counter
+from itertools import islice
+from utils import words
 from .btree import BTree, PersistentBTree
-from .persistence import TableFile, InvertedIndexFile, GamePersist, Uint32Persist, Uint32PairPersist, TagPersist, PublisherPersist, CommentPersist, ExpansionPersist, StringPersist
+from .cache import BufferPool
+from .columns import ColumnStore
+from .postings import intersect_postings, union_postings, rank_bm25
+from .persistence import Uint32Field, IncompatibleFileError, TableFile, HeapFile, CompressedHeapFile, InvertedIndexFile, GamePersist, Uint32Persist, Uint32PairPersist, TagPersist, PublisherPersist, CommentPersist, ExpansionPersist, StringPersist
+
+# Memory available to cache the pages of the database files
+POOL_BUDGET = 32 * 1024 * 1024
+
+# How many results ranked searches return by default
+RANKED_RESULTS = 50
+
+# How many words prefix searches look up by default
+COMPLETIONS = 64
+
+# Words of at least this many letters may have two typos, shorter ones one
+TWO_TYPOS = 8
+
+# Secondary indexes built with every database, as (table, field)
+INDEXES = [
+    ('games', 'year'),
+    ('games', 'max_playtime'),
+    ('expansions', 'year'),
+    ('comments', 'rating'),
+]
 
 class Database():
 
-    def __init__(self):
+    # With `compress_text` off, the text of the documents is stored as is,
+    # which takes more space but doesn't have to be decompressed to be read
+    def __init__(self, pool_budget=POOL_BUDGET, compress_text=True):
         if not os.path.exists('.bgg'):
             os.mkdir('.bgg')
 
+        self.compress_text = compress_text
+
+        # Tables, trees and indexes all read their pages through this pool.
+        # Some caches are kept outside of its budget: the pinned top levels
+        # of trees, bounded LRU caches of decompressed heap blocks, tree
+        # nodes and where the lists of inverted indexes are, and the loaded
+        # lengths, term dictionaries and trigram indexes of inverted
+        # indexes, which are as big as their files
+        self.pool = BufferPool(pool_budget)
+
+        try:
+            self.open()
+        except IncompatibleFileError:
+            # These files were written by an incompatible version, and can't
+            # be read. Start over with an empty database, to be filled again
+            self.reset()
+
+        # Every file of a build is stamped with the same generation, so mixed
+        # generations mean a build didn't finish and some files are stale
+        if len(set(self.generations())) > 1:
+            self.reset()
+
+        self.generation = max(self.generations())
+
+    def open(self):
         self.trees = {}
         self.tables = {}
         self.postings = {}
+        self.columns = {}
+        self.indexes = {}
 
-        # Base documents
+        # Base documents. The text of games, publishers, comments and expansions
+        # is kept in heaps (see open_heap)
         self.trees['games'] = PersistentBTree(
-            15, '.bgg/games.btree', Uint32PairPersist())
-        self.tables['games'] = TableFile('.bgg/games.table', GamePersist())
+            15, '.bgg/games.btree', pool=self.pool)
+        self.tables['games'] = TableFile(
+            '.bgg/games.table', GamePersist(self.open_heap('.bgg/games.heap')), use_mmap=True, pool=self.pool)
+
+        # Numeric attributes of games, to filter them by
+        self.columns['games'] = ColumnStore('.bgg/games', [
+            'id',
+            'year',
+            'min_players',
+            'max_players',
+            'min_playtime',
+            'max_playtime',
+            'min_age',
+        ])
 
         self.trees['categories'] = PersistentBTree(
-            15, '.bgg/categories.btree', Uint32PairPersist())
+            15, '.bgg/categories.btree', pool=self.pool)
         self.tables['categories'] = TableFile(
-            '.bgg/categories.table', TagPersist())
+            '.bgg/categories.table', TagPersist(), pool=self.pool)
 
         self.trees['mechanics'] = PersistentBTree(
-            15, '.bgg/mechanics.btree', Uint32PairPersist())
+            15, '.bgg/mechanics.btree', pool=self.pool)
         self.tables['mechanics'] = TableFile(
-            '.bgg/mechanics.table', TagPersist())
+            '.bgg/mechanics.table', TagPersist(), pool=self.pool)
 
         self.trees['publishers'] = PersistentBTree(
-            15, '.bgg/publishers.btree', Uint32PairPersist())
+            15, '.bgg/publishers.btree', pool=self.pool)
         self.tables['publishers'] = TableFile(
-            '.bgg/publishers.table', PublisherPersist())
+            '.bgg/publishers.table', PublisherPersist(self.open_heap('.bgg/publishers.heap')), use_mmap=True, pool=self.pool)
 
         self.trees['comments'] = PersistentBTree(
-            15, '.bgg/comments.btree', Uint32PairPersist())
+            15, '.bgg/comments.btree', pool=self.pool)
         self.tables['comments'] = TableFile(
-            '.bgg/comments.table', CommentPersist())
+            '.bgg/comments.table', CommentPersist(self.open_heap('.bgg/comments.heap')), use_mmap=True, pool=self.pool)
 
         self.trees['expansions'] = PersistentBTree(
-            15, '.bgg/expansions.btree', Uint32PairPersist())
+            15, '.bgg/expansions.btree', pool=self.pool)
         self.tables['expansions'] = TableFile(
-            '.bgg/expansions.table', ExpansionPersist())
+            '.bgg/expansions.table', ExpansionPersist(self.open_heap('.bgg/expansions.heap')), use_mmap=True, pool=self.pool)
         # N-N Relations
         self.tables['game_mechanic'] = TableFile(
-            '.bgg/game_mechanic.table', Uint32PairPersist())
+            '.bgg/game_mechanic.table', Uint32PairPersist(), pool=self.pool)
         self.postings['game_mechanic_mechanic'] = InvertedIndexFile(
-            '.bgg/game_mechanic_mechanic', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/game_mechanic_mechanic', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
         self.postings['game_mechanic_game'] = InvertedIndexFile(
-            '.bgg/game_mechanic_game', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/game_mechanic_game', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
 
         self.tables['game_category'] = TableFile(
-            '.bgg/game_category.table', Uint32PairPersist())
+            '.bgg/game_category.table', Uint32PairPersist(), pool=self.pool)
         self.postings['game_category_category'] = InvertedIndexFile(
-            '.bgg/game_category_category', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/game_category_category', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
         self.postings['game_category_game'] = InvertedIndexFile(
-            '.bgg/game_category_game', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/game_category_game', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
 
         self.tables['game_publisher'] = TableFile(
-            '.bgg/game_publisher.table', Uint32PairPersist())
+            '.bgg/game_publisher.table', Uint32PairPersist(), pool=self.pool)
         self.postings['game_publisher_publisher'] = InvertedIndexFile(
-            '.bgg/game_publisher_publisher', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/game_publisher_publisher', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
         self.postings['game_publisher_game'] = InvertedIndexFile(
-            '.bgg/game_publisher_game', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/game_publisher_game', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
         # Index to search for expansions by the game they expand
         self.postings['expansions_game'] = InvertedIndexFile(
-            '.bgg/expansions_game', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/expansions_game', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
         # Indexes to search comments by the item they comment
         self.postings['comments_game'] = InvertedIndexFile(
-            '.bgg/comments_game', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
+            '.bgg/comments_game', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
         self.postings['comments_expansion'] = InvertedIndexFile(
-            '.bgg/comments_expansion', make_hash(512), Uint32Persist(), Uint32Persist(), 16)
-        # Indexes to search by text content
+            '.bgg/comments_expansion', Uint32Persist(), Uint32Persist(), 16, pool=self.pool)
+        # Indexes to search by text content. They keep how many times each
+        # word appears, to rank results, and their words sorted and split in
+        # trigrams, to find them by prefix or despite typos
         self.postings['games_word'] = InvertedIndexFile(
-            '.bgg/games_word', make_hash(1024), StringPersist(40), Uint32Persist(), 16)
+            '.bgg/games_word', StringPersist(40), Uint32PairPersist(), 16, frequencies=True, terms=True, pool=self.pool)
+        self.postings['expansions_word'] = InvertedIndexFile(
+            '.bgg/expansions_word', StringPersist(40), Uint32PairPersist(), 16, frequencies=True, terms=True, pool=self.pool)
         self.postings['publishers_word'] = InvertedIndexFile(
-            '.bgg/publishers_word', make_hash(1024), StringPersist(40), Uint32Persist(), 16)
+            '.bgg/publishers_word', StringPersist(40), Uint32PairPersist(), 16, frequencies=True, terms=True, pool=self.pool)
         self.postings['mechanics_word'] = InvertedIndexFile(
-            '.bgg/mechanics_word', make_hash(1024), StringPersist(40), Uint32Persist(), 16)
+            '.bgg/mechanics_word', StringPersist(40), Uint32PairPersist(), 16, frequencies=True, terms=True, pool=self.pool)
         self.postings['categories_word'] = InvertedIndexFile(
-            '.bgg/categories_word', make_hash(1024), StringPersist(40), Uint32Persist(), 16)
+            '.bgg/categories_word', StringPersist(40), Uint32PairPersist(), 16, frequencies=True, terms=True, pool=self.pool)
+
+        # Where values are inserted into each index: the index itself, or
+        # its writer while building
+        self.writers = self.postings
+
+        # Secondary indexes, on numeric fields. Besides the ones in INDEXES,
+        # those added with create_index are found again by their files
+        for table, field in INDEXES:
+            self.open_index(table, field)
+        for filename in sorted(os.listdir('.bgg')):
+            if filename.endswith('.index'):
+                self.open_index(*filename.split('.')[:2])
+
+    # Opens a heap for the text of a table, compressed in blocks unless
+    # compress_text is off. Switching it makes the old heaps incompatible,
+    # so the database is filled again
+    def open_heap(self, filename):
+        if self.compress_text:
+            return CompressedHeapFile(filename, pool=self.pool)
+
+        return HeapFile(filename, pool=self.pool)
+
+    # Opens the index of a table's field. Its keys are the field's sort key
+    # in the high 32 bits and the row in the low ones, so rows sharing a
+    # value are still different keys, and values are the rows
+    def open_index(self, table, field):
+        if (table, field) in self.indexes:
+            return
+
+        if not isinstance(self.tables[table].persist.layout[field][0], Uint32Field):
+            raise Exception(f'Field {field} of {table} is not numeric')
+
+        self.indexes[(table, field)] = PersistentBTree(
+            15, f'.bgg/{table}.{field}.index', key_type='Q', pool=self.pool)
 
+    # Closes and deletes every file of the database, then opens it empty
+    def reset(self):
+        self.close()
+
+        for filename in os.listdir('.bgg'):
+            os.remove(os.path.join('.bgg', filename))
+
+        self.open()
+
+    def generations(self):
+        res = []
+
+        for table in self.tables:
+            res.append(self.tables[table].header.generation)
+
+        for tree in self.trees:
+            res.append(self.trees[tree].header.generation)
+
+        for posting in self.postings:
+            res.append(self.postings[posting].key_header.generation)
+
+        for index in self.indexes:
+            res.append(self.indexes[index].header.generation)
+
+        for document in self.columns:
+            for column in self.columns[document].columns:
+                res.append(self.columns[document].headers[column].generation)
+
+        return res
 
     def initial_data(self,
                      games,
@@ -95,11 +228,15 @@ class Database():
                      game_category,
                      game_publisher,
                      notifier):
-        # Empty some indexes first
+        # Every file of this build is stamped with the same generation
+        self.generation += 1
+        # Empty some indexes first, and fill them in bulk during the build
         for p in self.postings:
-            self.postings[p].delete()
+            self.postings[p].delete(self.generation)
+        self.writers = {p: self.postings[p].bulk_insert() for p in self.postings}
         # Create the base documents
         self.make_document('games', games, 'id', notifier, self.games_hook)
+        self.make_columns('games', games, notifier)
         self.make_document('mechanics', mechanics, 'id', notifier, self.mechanics_hook)
         self.make_document('categories', categories, 'id', notifier, self.categories_hook)
         self.make_document('publishers', publishers, 'id', notifier, self.publishers_hook)
@@ -109,41 +246,115 @@ class Database():
         self.make_relation('game', 'mechanic', game_mechanic, notifier)
         self.make_relation('game', 'category', game_category, notifier)
         self.make_relation('game', 'publisher', game_publisher, notifier)
+        # Write the posting lists gathered by the writers
+        notifier.message('Writing indexes...')
+        for p in self.writers:
+            self.writers[p].flush()
+        self.writers = self.postings
+        # Index the numeric fields
+        for table, field in self.indexes:
+            self.make_index(table, field, notifier)
 
     def make_document(self, document, data, key, notifier, hook=None):
         notifier.message(f'Building {document}...')
 
-        ids = BTree(self.trees[document].order)
-        self.tables[document].delete()
+        pairs = []
+        self.tables[document].delete(self.generation)
         notifier.start_progress(len(data))
-        for element in data:
-            index = self.tables[document].insert(element)
-            ids.insert(element[key], index)
-            if hook != None:
-                hook(element, index)
-            notifier.progress()
-        self.trees[document].dump(ids)
+        with self.tables[document].bulk_insert() as writer:
+            for element in data:
+                index = writer.insert(element)
+                pairs.append((element[key], index))
+                if hook != None:
+                    hook(element, index)
+                notifier.progress()
+
+        ids = BTree(self.trees[document].order)
+        ids.bulk_load(pairs)
+        self.trees[document].dump(ids, self.generation)
+
+    # Adds a single document, indexing it like the ones of the initial data.
+    # Only the pages it touches are written, nothing is rebuilt
+    def insert_document(self, document, element, key='id'):
+        if self.trees[document].find(element[key]) != None:
+            raise Exception(f'Duplicate key {element[key]} in {document}')
+
+        index = self.tables[document].insert(element)
+        self.trees[document].insert(element[key], index)
+
+        if document in self.columns:
+            self.columns[document].insert(element)
+
+        for table, field in self.indexes:
+            if table == document:
+                key = self.index_key(table, field, element[field], index)
+                if key != None:
+                    self.indexes[(table, field)].insert(key, index)
+
+        hook = getattr(self, document + '_hook', None)
+        if hook != None:
+            hook(element, index)
+
+        return index
+
+    # Adds an index on a numeric field of a table, to be kept up to date
+    # from now on (see get_by_index)
+    def create_index(self, table, field, notifier=None):
+        if (table, field) in self.indexes:
+            return
+
+        self.open_index(table, field)
+        self.make_index(table, field, notifier)
+
+    def make_index(self, table, field, notifier=None):
+        if notifier != None:
+            notifier.message(f'Indexing {table} by {field}...')
+
+        pairs = []
+        for row, item in enumerate(self.tables[table].scan([field])):
+            key = self.index_key(table, field, item[field], row)
+            if key != None:
+                pairs.append((key, row))
+        pairs.sort()
+
+        tree = BTree(self.indexes[(table, field)].order)
+        tree.bulk_load(pairs)
+        self.indexes[(table, field)].dump(tree, self.generation)
+
+    # Returns the key of a row on an index, None for values we don't index
+    def index_key(self, table, field, value, row):
+        if value == None:
+            return None
+
+        return self.tables[table].persist.layout[field][0].sort_key(value) << 32 | row
+
+    def make_columns(self, document, data, notifier):
+        notifier.message(f'Building {document} columns...')
+
+        self.columns[document].build(data, self.generation)
 
     def make_relation(self, entity_a, entity_b, relation_data, notifier, hook=None):
         rel_name = entity_a + '_' + entity_b
 
         notifier.message(f'Building {rel_name}...')
 
-        self.tables[rel_name].delete()
-        self.postings[rel_name + '_' + entity_a].delete()
-        self.postings[rel_name + '_' + entity_b].delete()
+        self.tables[rel_name].delete(self.generation)
+        self.postings[rel_name + '_' + entity_a].delete(self.generation)
+        self.postings[rel_name + '_' + entity_b].delete(self.generation)
 
         notifier.start_progress(len(relation_data))
-        for data_a, data_b in relation_data:
-            index = self.tables[rel_name].insert((data_a, data_b))
-            self.postings[rel_name + '_' + entity_a].insert(data_a, index)
-            self.postings[rel_name + '_' + entity_b].insert(data_b, index)
-            if hook != None:
-                hook(data_a, data_b, index)
-            notifier.progress()
+        with self.tables[rel_name].bulk_insert() as writer:
+            for data_a, data_b in relation_data:
+                index = writer.insert((data_a, data_b))
+                self.writers[rel_name + '_' + entity_a].insert(data_a, index)
+                self.writers[rel_name + '_' + entity_b].insert(data_b, index)
+                if hook != None:
+                    hook(data_a, data_b, index)
+                notifier.progress()
 
     def expansions_hook(self, expansion, index):
-        self.postings['expansions_game'].insert(expansion['game_id'], index)
+        self.writers['expansions_game'].insert(expansion['game_id'], index)
+        self.build_search_index('expansions', ['name', 'description'], expansion, index)
 
     def games_hook(self, game, index):
         self.build_search_index('games', ['description', 'name'], game, index)
@@ -159,9 +370,9 @@ class Database():
 
     def comments_hook(self, comment, index):
         if comment['game_id'] != None:
-            self.postings['comments_game'].insert(comment['game_id'], index)
+            self.writers['comments_game'].insert(comment['game_id'], index)
         elif comment['expansion_id'] != None:
-            self.postings['comments_expansion'].insert(comment['expansion_id'], index)
+            self.writers['comments_expansion'].insert(comment['expansion_id'], index)
         else:
             raise Exception('Invalid comment found!')
 
@@ -173,25 +384,142 @@ class Database():
         else:
             string = object[key]
 
-        for token in tokenize(string):
-            self.postings[document + '_word'].insert(token, index)
+        counts = Counter(words(string))
+        for token in counts:
+            self.writers[document + '_word'].insert(token, index, counts[token])
 
-    def get_by_key(self, table, key):
+    # `fields` optionally restricts the fields decoded for each record,
+    # so listings don't have to pay for the ones they don't show
+    def get_by_key(self, table, key, fields=None):
         index = self.trees[table].find(key)
 
         if index == None:
             return None
 
-        return self.tables[table].load(index)
+        return self.tables[table].load(index, fields)
+
+    # Returns how many records a table has
+    def count(self, table):
+        return self.tables[table].count()
+
+    # Returns the ids of the documents whose columns match every condition
+    # (see ColumnStore.filter)
+    def filter(self, document, conditions):
+        rows = self.columns[document].filter(conditions)
+        ids = self.columns[document].column('id')
+
+        return [int(ids[row]) for row in rows]
+
+    # Returns the rows of the records with the given keys, leaving out the
+    # keys that are missing
+    def find_rows(self, table, keys):
+        return [row for row in self.trees[table].find_many(keys) if row != None]
+
+    # Same as get_by_key, for several keys at once. Missing keys yield None
+    def get_many_by_key(self, table, keys, fields=None):
+        indices = self.trees[table].find_many(keys)
+
+        records = iter(self.tables[table].load_many([i for i in indices if i != None], fields))
+
+        return [next(records) if i != None else None for i in indices]
+
+    # Returns the records whose keys are between lo and hi (both included,
+    # None leaves that side open) in key order, at most `limit` of them
+    def get_range_by_key(self, table, lo=None, hi=None, limit=None, fields=None):
+        indices = [index for _, index in islice(self.trees[table].range(lo, hi), limit)]
+
+        return self.tables[table].load_many(indices, fields)
+
+    # Returns the records whose field is between lo and hi (both included,
+    # None leaves that side open), ordered by it, at most `limit` of them.
+    # With `reverse` set they're ordered from the greatest value down.
+    # The field must have been indexed (see create_index)
+    def get_by_index(self, table, field, lo=None, hi=None, limit=None, reverse=False, fields=None):
+        sort_key = self.tables[table].persist.layout[field][0].sort_key
+
+        lo = sort_key(lo) << 32 if lo != None else None
+        hi = sort_key(hi) << 32 | 0xFFFFFFFF if hi != None else None
+
+        rows = [row for _, row in islice(self.indexes[(table, field)].range(lo, hi, reverse), limit)]
+
+        return self.tables[table].load_many(rows, fields)
 
-    def get_by_posting(self, posting, posting_key, key):
+    # Returns the rows of a document whose text has every one of the tokens,
+    # sorted
+    def match_words(self, document, tokens):
+        return intersect_postings([self.postings[document + '_word'].get_postings(token) for token in tokens])
+
+    # Returns the rows of a document that best match the tokens, ranked with
+    # BM25, as (row, score) pairs from the best down. Only the best `k` of
+    # them are scored in full, or all of them when `k` is None. When
+    # `allowed` is given, only the rows in it are ranked
+    def rank_words(self, document, tokens, k=RANKED_RESULTS, allowed=None):
+        index = self.postings[document + '_word']
+        postings = [index.get_postings(token) for token in tokens]
+        documents = self.tables[document].count()
+
+        if k == None:
+            k = documents
+
+        return rank_bm25(postings, index.lengths(), index.average_length(), documents, k, allowed)
+
+    # Returns the words of a document's text that start with prefix, in
+    # order, at most `limit` of them
+    def complete_word(self, document, prefix, limit=COMPLETIONS):
+        return self.postings[document + '_word'].prefix(prefix, limit)
+
+    # Returns the rows of a document whose text has a word starting with
+    # prefix, sorted. Only the first `limit` such words are looked up
+    def match_prefix(self, document, prefix, limit=COMPLETIONS):
+        index = self.postings[document + '_word']
+
+        return union_postings([index.get_postings(word) for word in index.prefix(prefix, limit)])
+
+    # Returns the words of a document's text that are a few typos away from
+    # a word, as (distance, word) pairs from the closest. Unless told how
+    # many, longer words may have more typos
+    def similar_words(self, document, word, distance=None):
+        if distance == None:
+            distance = 2 if len(word) >= TWO_TYPOS else 1
+
+        return self.postings[document + '_word'].similar(word, distance)
+
+    # Returns, for each token, the words of a document's text to look for
+    # instead: the token itself when it's there, otherwise the words closest
+    # to it (none when there are none within a few typos)
+    def correct_words(self, document, tokens):
+        index = self.postings[document + '_word']
         res = []
 
-        for index in self.postings[posting + '_' + posting_key].get_values(key):
-            res.append(self.tables[posting].load(index))
+        for token in tokens:
+            if index.find_key(token) != None:
+                res.append([token])
+                continue
+
+            similar = self.similar_words(document, token)
+            res.append([word for distance, word in similar if distance == similar[0][0]])
 
         return res
 
+    # Same as match_words, matching the words closest to the tokens that
+    # aren't on the document's text (see correct_words)
+    def match_similar(self, document, tokens):
+        index = self.postings[document + '_word']
+
+        return intersect_postings([
+            union_postings([index.get_postings(word) for word in alternatives]) for alternatives in self.correct_words(document, tokens)
+        ])
+
+    # Same as rank_words, ranking with the words closest to the tokens that
+    # aren't on the document's text (see correct_words)
+    def rank_similar(self, document, tokens, k=RANKED_RESULTS, allowed=None):
+        return self.rank_words(document, [word for alternatives in self.correct_words(document, tokens) for word in alternatives], k, allowed)
+
+    def get_by_posting(self, posting, posting_key, key, fields=None):
+        indices = self.postings[posting + '_' + posting_key].get_values(key)
+
+        return self.tables[posting].load_many(indices, fields)
+
     def close(self):
         for table in self.tables:
             self.tables[table].close()
@@ -202,6 +530,9 @@ class Database():
         for posting in self.postings:
             self.postings[posting].close()
 
+        for document in self.columns:
+            self.columns[document].close()
+
+        for index in self.indexes:
+            self.indexes[index].close()
 
-def make_hash(mod):
-    return lambda x: int(md5(bytes(str(x), 'utf-8')).hexdigest(), 16) % mod
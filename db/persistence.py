@@ -1,119 +1,767 @@
 import struct
 import os
+import mmap
+import zlib
+import heapq
+from bisect import bisect_left, insort
+from array import array
+from itertools import groupby
 from utils import openfile
+from .cache import LRUCache
+from .postings import PostingList, encode_run
+from .terms import TermDictionary, GramIndex, encode_terms, encode_grams, similar_terms, edit_distance
+
+# Reads of items that are at most this many bytes apart get merged into one
+COALESCE_GAP = 64 * 1024
+# How many bytes bulk writes keep in memory before writing them out
+WRITE_BUFFER = 1024 * 1024
+# How many (key, value) pairs bulk index builds keep in memory before
+# spilling them to disk
+INDEX_BUDGET = 512 * 1024
+# How many keys added to an index with terms are kept in memory before its
+# terms file is written again
+ADDED_TERMS = 1024
+
+# Header at the start of every database file: magic, format version,
+# record size, record count, build generation and 3 format-specific slots
+HEADER = struct.Struct('<4sIIII3I')
+
+class IncompatibleFileError(Exception):
+    def __init__(self, filename, reason):
+        super().__init__(f'{filename}: {reason}')
+        self.filename = filename
+
+class FileHeader():
+    # Reads the header of a file, or writes a new one if the file is empty.
+    # Raises IncompatibleFileError when the file holds something other than
+    # what we expect
+    def __init__(self, file, magic, version, record_size):
+        self.file = file
+        self.magic = magic
+        self.version = version
+        self.record_size = record_size
+
+        self.count = 0
+        self.generation = 0
+        self.extra = [0, 0, 0]
 
-class TableFile():
+        self.file.seek(0)
+        arr = self.file.read(HEADER.size)
 
-    def __init__(self, filename, persist):
-        self.file = openfile(filename)
-        self.persist = persist
+        if len(arr) == 0:
+            # Brand new file
+            self.write()
+            return
+
+        try:
+            self.read(arr)
+        except IncompatibleFileError:
+            # Whoever opened the file won't get to close it
+            self.file.close()
+            raise
+
+    # Checks and loads a header read from the file
+    def read(self, arr):
+        if len(arr) != HEADER.size:
+            raise IncompatibleFileError(self.file.name, 'truncated header')
+
+        magic, version, record_size, self.count, self.generation, *self.extra = HEADER.unpack(arr)
+
+        if magic != self.magic:
+            raise IncompatibleFileError(self.file.name, f'expected a {self.magic} file, found {magic}')
 
-    # Loads the n-th (0-based) item of the file
-    def load(self, n):
-        self.file.seek(self.persist.data_size * n)
+        if version != self.version:
+            raise IncompatibleFileError(self.file.name, f'expected format version {self.version}, found {version}')
 
-        return self.persist.from_bytes(self.file.read(self.persist.data_size))
+        if record_size != self.record_size:
+            raise IncompatibleFileError(self.file.name, f'expected records of {self.record_size} bytes, found {record_size}')
+
+    def write(self):
+        self.file.seek(0)
+        self.file.write(HEADER.pack(
+            self.magic,
+            self.version,
+            self.record_size,
+            self.count,
+            self.generation,
+            *self.extra
+        ))
+
+    # Empties the file, leaving only the header. `generation` defaults
+    # to the one after the current
+    def reset(self, generation=None):
+        self.count = 0
+        self.generation = generation if generation != None else self.generation + 1
+        self.extra = [0, 0, 0]
 
-    # Deletes all the data in the table
-    def delete(self):
         self.file.seek(0)
         self.file.truncate()
+        self.write()
+
+class TableFile():
+    MAGIC = b'BGGT'
+    VERSION = 1
+
+    def __init__(self, filename, persist, use_mmap=False, pool=None):
+        self.file = open_pooled(filename, pool)
+        self.persist = persist
+        # Codecs with variable-length fields keep them in a heap file
+        self.heap = getattr(persist, 'heap', None)
+
+        try:
+            self.header = FileHeader(self.file, self.MAGIC, self.VERSION, persist.data_size)
+        except IncompatibleFileError:
+            # The heap is ours to close
+            if self.heap != None:
+                self.heap.close()
+            raise
+
+        # When enabled, items are read through a memory map of the file,
+        # which is (re)created lazily whenever a load goes past its end
+        self.use_mmap = use_mmap
+        self.map = None
+
+    # Returns the position of the n-th (0-based) item in the file
+    def position(self, n):
+        return HEADER.size + self.persist.data_size * n
+
+    # Loads the n-th (0-based) item of the file. `fields` optionally
+    # restricts which fields of the item get decoded
+    def load(self, n, fields=None):
+        return self.load_many([n], fields)[0]
+
+    # Loads several items, returning them in the same order as `indices`.
+    # Items are fetched in file order: the ones close to each other are
+    # read all at once, and unpacked together.
+    # With a memory map, items are unpacked straight from it
+    def load_many(self, indices, fields=None):
+        size = self.persist.data_size
+        raws = {}
+
+        # Make sure we got valid indices
+        assert all(n < self.header.count for n in indices)
+
+        # Items appended after the map was created are not covered by it
+        if self.use_mmap and len(indices) > 0 and (self.map == None or self.position(max(indices) + 1) > len(self.map)):
+            self.remap()
+
+        spans = [(self.position(n), self.position(n + 1), n) for n in set(indices)]
+
+        for start, end, items in coalesce(spans):
+            if self.use_mmap:
+                buffer = memoryview(self.map)[start:end]
+            else:
+                self.file.seek(start)
+                buffer = self.file.read(end - start)
+
+            run = list(self.persist.unpack_many(buffer))
+
+            for n in items:
+                raws[n] = run[(self.position(n) - start) // size]
+
+        return self.decode([raws[n] for n in indices], fields)
+
+    # Loads every item in the table, in order. Items are read and unpacked
+    # in large chunks
+    def scan(self, fields=None):
+        size = self.persist.data_size
+        chunk = max(1, WRITE_BUFFER // size)
+
+        for first in range(0, self.header.count, chunk):
+            last = min(first + chunk, self.header.count)
+
+            self.file.seek(self.position(first))
+            buffer = self.file.read(self.position(last) - self.position(first))
+
+            for item in self.decode(list(self.persist.unpack_many(buffer)), fields):
+                yield item
+
+    # Decodes unpacked items
+    def decode(self, raws, fields=None):
+        # Only record codecs know about fields
+        if fields == None:
+            return self.persist.from_raws(raws)
+
+        return self.persist.from_raws(raws, fields)
+
+    # Maps the whole file into memory. The previous map is not closed,
+    # since views handed out from it may still be alive: it's released
+    # once the last one of them is gone
+    def remap(self):
+        # Make sure pending writes reach the file before mapping it
+        self.file.flush()
+
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Deletes all the data in the table, stamping it with a new generation
+    def delete(self, generation=None):
+        # Drop the map before it outlives the data it points to
+        self.map = None
+
+        self.header.reset(generation)
+
+        if self.heap != None:
+            self.heap.delete(self.header.generation)
+
+    # Inserts an item and returns its 0-based index
+    def insert(self, item):
+        index = self.header.count
+
+        # Write the new item, after its text
+        bts = self.persist.to_bytes(item)
+
+        if self.heap != None:
+            self.heap.flush()
+
+        self.file.seek(self.position(index))
+        self.file.write(bts)
+
+        self.header.count += 1
+        self.header.write()
+
+        return index
+
+    # Inserts several items, returning their indices
+    def insert_many(self, items):
+        with self.bulk_insert() as writer:
+            return writer.insert_many(items)
+
+    # Returns a TableWriter, to be used as a context manager
+    def bulk_insert(self):
+        return TableWriter(self)
+
+    # Returns how many items we have
+    def count(self):
+        return self.header.count
+
+    def close(self):
+        self.map = None
+        self.file.close()
+
+        if self.heap != None:
+            self.heap.close()
+
+class TableWriter():
+    # Appends items to a table in bulk: the next index is kept in memory,
+    # and items are packed in a buffer that is written in large chunks.
+    # Items are only guaranteed to be in the file after a flush, which
+    # happens when leaving the `with` block
+    def __init__(self, table):
+        self.table = table
+        self.buffer = bytearray()
+
+        # Index of the next item, and of the first one in the buffer
+        self.index = self.table.header.count
+        self.flushed = self.index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
 
     # Inserts an item and returns its 0-based index
     def insert(self, item):
-        # Jump to the end
-        self.file.seek(0, 2)
-        # Calculate new item's index
-        index = int(self.file.tell() / self.persist.data_size)
+        self.buffer += self.table.persist.to_bytes(item)
 
-        # Assert we got a valid positon
-        assert self.file.tell() % self.persist.data_size == 0
+        index = self.index
+        self.index += 1
 
-        # Write the new item
-        self.file.write(self.persist.to_bytes(item))
+        if len(self.buffer) >= WRITE_BUFFER:
+            self.flush()
 
         return index
 
-    def count():
-        # Jump to the end
-        self.file.seek(0, 2)
-        # Count how many items do we have
-        total = int(self.file.tell() / self.persist.data_size)
+    def insert_many(self, items):
+        return [self.insert(item) for item in items]
+
+    def flush(self):
+        # Text must be in the heap before the records pointing to it are
+        if self.table.heap != None:
+            self.table.heap.flush()
+
+        self.table.file.seek(self.table.position(self.flushed))
+        self.table.file.write(self.buffer)
+        self.buffer = bytearray()
+        self.flushed = self.index
+
+        self.table.header.count = self.index
+        self.table.header.write()
+
+class HeapFile():
+    # Stores variable-length byte strings one after the other. Each of
+    # them is referenced by its (offset, length) inside the file's data.
+    # Appended strings are buffered, and written out in large chunks.
+    # The header counts how many bytes of data we have
+    MAGIC = b'BGGH'
+    VERSION = 1
+
+    def __init__(self, filename, pool=None):
+        self.file = open_pooled(filename, pool)
+        self.header = FileHeader(self.file, self.MAGIC, self.VERSION, 1)
+        self.pending = bytearray()
+
+        self.size = self.header.count
+
+    # Appends a string and returns its (offset, length)
+    def append(self, bts):
+        offset = self.size
+
+        self.pending += bts
+        self.size += len(bts)
+
+        if len(self.pending) >= WRITE_BUFFER:
+            self.flush()
+
+        return (offset, len(bts))
+
+    # Writes the pending strings to the file
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        self.file.seek(HEADER.size + self.header.count)
+        self.file.write(self.pending)
+        self.pending = bytearray()
 
-        # Assert it is an integer
-        assert self.file.tell() % self.persist.data_size == 0
+        self.header.count = self.size
+        self.header.write()
 
-        return total
+    def read(self, offset, length):
+        if length == 0:
+            return b''
+
+        self.flush()
+        self.file.seek(HEADER.size + offset)
+
+        return self.file.read(length)
+
+    # Reads several (offset, length) strings, merging the reads of the
+    # ones close to each other. Results are in the same order as `refs`
+    def read_many(self, refs):
+        res = {}
+        spans = [(offset, offset + length, (offset, length)) for offset, length in set(refs)]
+
+        self.flush()
+
+        for start, end, items in coalesce(spans):
+            self.file.seek(HEADER.size + start)
+            bts = self.file.read(end - start)
+
+            for offset, length in items:
+                res[(offset, length)] = bts[offset - start:offset - start + length]
+
+        return [res[tuple(ref)] for ref in refs]
+
+    def delete(self, generation=None):
+        self.header.reset(generation)
+        self.pending = bytearray()
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class CompressedHeapFile():
+    # A HeapFile whose strings are compressed with zlib in blocks of
+    # `block_size` strings. Each string is referenced by its (number, length),
+    # and blocks are read through an LRU cache of decompressed blocks.
+    # A decompressed block starts with how many strings it has, and their
+    # offsets inside of it.
+    # The (offset, length) of each block in the file is kept in a second
+    # file, which is loaded in memory. The header counts the strings that
+    # are written in the file. The last block may be written before it
+    # fills up (see flush), and is written again in its place as it grows
+    MAGIC = b'BGGZ'
+    INDEX_MAGIC = b'BGGI'
+    VERSION = 1
+
+    def __init__(self, filename, block_size=32, cache_size=64, pool=None):
+        self.block_size = block_size
+        self.cache = LRUCache(cache_size)
+
+        self.file = open_pooled(filename, pool)
+        self.header = FileHeader(self.file, self.MAGIC, self.VERSION, block_size)
+
+        self.index_file = open_pooled(filename + '.blocks', pool)
+        try:
+            self.index_header = FileHeader(self.index_file, self.INDEX_MAGIC, self.VERSION, 4 * 2)
+        except IncompatibleFileError:
+            self.file.close()
+            raise
+
+        self.index = array('I')
+        self.index_file.seek(HEADER.size)
+        self.index.frombytes(self.index_file.read(self.index_header.count * 4 * 2))
+
+        # Strings of the last block, until it fills up, and how many of
+        # them are in the partial block written in the file
+        self.pending = []
+        self.written = 0
+
+        # The last block written may be partial, load it back so it can be completed
+        if self.header.count % self.block_size != 0:
+            self.pending = self.load_block(len(self.index) // 2 - 1)
+            self.written = len(self.pending)
+
+    # Returns how many strings are in full blocks
+    def filled(self):
+        return self.header.count - self.written
+
+    # Appends a string and returns its (number, length)
+    def append(self, bts):
+        number = self.filled() + len(self.pending)
+
+        self.pending.append(bytes(bts))
+
+        if len(self.pending) == self.block_size:
+            self.write_block()
+
+        return (number, len(bts))
+
+    # Compresses and writes the pending strings as a block at the end of the
+    # file, in place of the partial block written before, if any
+    def write_block(self):
+        # How many strings we have, followed by their offsets
+        offsets = array('I', [len(self.pending), 0])
+        for bts in self.pending:
+            offsets.append(offsets[-1] + len(bts))
+
+        block = zlib.compress(offsets.tobytes() + b''.join(self.pending))
+
+        if self.written > 0:
+            del self.index[-2:]
+            self.header.count -= self.written
+
+        # Blocks are written right after the previous one
+        offset = self.index[-2] + self.index[-1] if len(self.index) > 0 else 0
+
+        self.file.seek(HEADER.size + offset)
+        self.file.write(block)
+        self.file.truncate()
+
+        self.index.extend([offset, len(block)])
+        self.index_file.seek(HEADER.size + (len(self.index) - 2) * 4)
+        self.index_file.write(self.index[-2:].tobytes())
+
+        self.header.count += len(self.pending)
+        self.header.write()
+        self.index_header.count = len(self.index) // 2
+        self.index_header.write()
+
+        if len(self.pending) == self.block_size:
+            self.pending = []
+            self.written = 0
+        else:
+            self.written = len(self.pending)
+
+    # Full blocks are written as soon as they fill up. This writes the last
+    # one too, partial as it is
+    def flush(self):
+        if len(self.pending) > self.written:
+            self.write_block()
+
+    # Returns the strings of the n-th (0-based) block
+    def read_block(self, n):
+        # The block being filled may be in the file, but it's only up to
+        # date in memory
+        if n == self.filled() // self.block_size:
+            return self.pending
+
+        strings = self.cache.get(n)
+
+        if strings == None:
+            strings = self.load_block(n)
+            self.cache.put(n, strings)
+
+        return strings
+
+    # Reads and decompresses the n-th block from the file
+    def load_block(self, n):
+        self.file.seek(HEADER.size + self.index[2 * n])
+
+        return self.decompress(self.file.read(self.index[2 * n + 1]))
+
+    def decompress(self, block):
+        block = zlib.decompress(block)
+
+        count = struct.unpack_from('I', block)[0]
+        offsets = array('I')
+        offsets.frombytes(block[4:(count + 2) * 4])
+
+        start = (count + 2) * 4
+        return [block[start + offsets[i]:start + offsets[i + 1]] for i in range(count)]
+
+    def read(self, number, length):
+        if length == 0:
+            return b''
+
+        return self.read_block(number // self.block_size)[number % self.block_size]
+
+    # Reads several (number, length) strings, decompressing each of their
+    # blocks once. Results are in the same order as `refs`
+    def read_many(self, refs):
+        blocks = set(number // self.block_size for number, length in refs if length > 0)
+
+        # Blocks we'll have to read from the file
+        spans = []
+        for n in blocks:
+            if n < self.filled() // self.block_size and n not in self.cache.items:
+                spans.append((self.index[2 * n], self.index[2 * n] + self.index[2 * n + 1], n))
+
+        for start, end, items in coalesce(spans):
+            self.file.seek(HEADER.size + start)
+            bts = self.file.read(end - start)
+
+            for n in items:
+                offset = self.index[2 * n] - start
+                self.cache.put(n, self.decompress(bts[offset:offset + self.index[2 * n + 1]]))
+
+        return [self.read(number, length) for number, length in refs]
+
+    def delete(self, generation=None):
+        self.header.reset(generation)
+        self.index_header.reset(self.header.generation)
+        self.index = array('I')
+        self.pending = []
+        self.written = 0
+        self.cache.clear()
 
     def close(self):
+        self.flush()
+
         self.file.close()
+        self.index_file.close()
 
 class InvertedIndexFile():
-    def __init__(self, filename, hash_key, key_persist, value_persist, block_size):
-        self.hash_key = hash_key
-        self.value_file = openfile(filename + '.dictionary')
-        self.key_file = openfile(filename + '.posting')
+    # Maps keys to lists of values. The key file is a hash directory of
+    # `capacity` slots, each holding a key and where its list is. Keys are
+    # hashed with CRC32 and collisions resolved by linear probing, wrapping
+    # around at the end. Once the directory is fuller than MAX_LOAD it
+    # doubles, and every key is moved to its slot on the new one.
+    # The key header counts keys, and its first extra slot is the capacity.
+    # Inserted values go to chains of blocks on the value file. An empty
+    # index is better filled with an IndexWriter, which writes every list
+    # to the runs file instead, as a sorted run of delta encoded blocks
+    # with skip pointers (see db.postings), so reading it takes a single
+    # read. Values inserted afterwards go to a new chain, read after the
+    # run.
+    # With `frequencies`, every value is stored along with how many times
+    # it was inserted for its key (chains then hold pairs, so value_persist
+    # must be a Uint32PairPersist), and the lengths file keeps, for every
+    # value, the sum of its frequencies. Its header counts values, and its
+    # first extra slot holds the sum of them all.
+    # With `terms`, whose keys must be strings, the terms file keeps every
+    # key sorted and front coded (see db.terms), to find keys by prefix.
+    # Its header counts bytes, and its first extra slot how many keys it
+    # holds. Keys added since are kept sorted in memory and searched along
+    # with it, until there are ADDED_TERMS of them or the index is closed,
+    # when it's written again.
+    # The grams file, written along, is a trigram index of the keys, to find
+    # those a few typos away from a string. Its header counts bytes too
+    KEY_MAGIC = b'BGGK'
+    VALUE_MAGIC = b'BGGV'
+    RUNS_MAGIC = b'BGGR'
+    LENGTHS_MAGIC = b'BGGL'
+    TERMS_MAGIC = b'BGGD'
+    GRAMS_MAGIC = b'BGGN'
+    VERSION = 7
+
+    CAPACITY = 1024
+    MAX_LOAD = 0.7
+
+    # First block of lists without a chain
+    NO_BLOCK = 0xFFFFFFFF
+
+    # How many keys the caches of where lists are, and of the last block
+    # of their chains, keep
+    KEY_CACHE = 4096
+
+    def __init__(self, filename, key_persist, value_persist, block_size, frequencies=False, terms=False, pool=None):
+        self.value_file = open_pooled(filename + '.dictionary', pool)
+        self.key_file = open_pooled(filename + '.posting', pool)
+        self.runs_file = open_pooled(filename + '.runs', pool)
+
+        if frequencies:
+            self.lengths_file = open_pooled(filename + '.lengths', pool)
+
+        if terms:
+            self.terms_file = open_pooled(filename + '.terms', pool)
+            self.grams_file = open_pooled(filename + '.grams', pool)
         self.key_persist = key_persist
         self.value_persist = value_persist
         self.block_size = block_size
-        self.index_cache = {}
-        self.insert_index_cache = {}
-
-    def insert(self, key, value):
-        # Check if key already exists
-        if key in self.index_cache:
-            index = self.index_cache[key]
-            if key in self.insert_index_cache:
-                index = self.insert_index_cache[key]
+        self.frequencies = frequencies
+        self.terms = terms
+        self.index_cache = LRUCache(self.KEY_CACHE)
+        self.insert_index_cache = LRUCache(self.KEY_CACHE)
+        # Loaded lengths, term dictionary and trigram index
+        self.lengths_cache = None
+        self.terms_cache = None
+        self.grams_cache = None
+        # Bytes of the keys added since the terms file was written, sorted
+        self.added = []
+
+        # Each slot of the key file holds a key, the index of the first
+        # block of its chain, and the position and size of its run
+        self.entry = struct.Struct('III')
+        self.slot_size = self.key_persist.data_size + self.entry.size
+        self.block_bytes = self.value_persist.data_size * self.block_size + 4
+
+        # The key file counts keys, the value file counts blocks, and the
+        # runs file bytes
+        try:
+            self.key_header = FileHeader(self.key_file, self.KEY_MAGIC, self.VERSION, self.slot_size)
+            self.value_header = FileHeader(self.value_file, self.VALUE_MAGIC, self.VERSION, self.block_bytes)
+            self.runs_header = FileHeader(self.runs_file, self.RUNS_MAGIC, self.VERSION, 1)
+
+            if self.frequencies:
+                self.lengths_header = FileHeader(self.lengths_file, self.LENGTHS_MAGIC, self.VERSION, 4)
+
+            if self.terms:
+                self.terms_header = FileHeader(self.terms_file, self.TERMS_MAGIC, self.VERSION, 1)
+                self.grams_header = FileHeader(self.grams_file, self.GRAMS_MAGIC, self.VERSION, 1)
+        except IncompatibleFileError:
+            self.close()
+            raise
+
+    def insert(self, key, value, frequency=1):
+        if self.frequencies:
+            self.add_length(value, frequency)
+            value = (value, frequency)
+
+        # We know the last block of this key's chain
+        index = self.insert_index_cache.get(key)
+        if index != None:
             self.insert_value_old(key, value, index)
             return
 
-        # Locate key spot
-        file_position = self.hash_key(key) * (self.key_persist.data_size + 4)
+        if self.key_header.count + 1 > self.capacity() * self.MAX_LOAD:
+            self.resize(max(self.CAPACITY, self.capacity() * 2))
 
-        while True:
-            self.key_file.seek(file_position)
-            arr = self.key_file.read(self.key_persist.data_size)
+        slot, entry = self.probe(key)
+        self.index_cache.remove(key)
 
-            if len(arr) == 0:
-                # Got to the end of the file and have not yet found our key.
-                # Insert it here
-                self.key_file.write(self.key_persist.to_bytes(key))
-                value_index = self.insert_value_new(key, value)
+        if entry == None:
+            # Our slot is empty, write the key here
+            block = self.insert_value_new(key, value)
 
-                self.key_file.write(struct.pack('I', value_index))
-                self.index_cache[key] = value_index
-                break
-            else:
-                # Check if this slot is empty
-                file_key = self.key_persist.from_bytes(arr)
+            self.key_file.seek(self.slot_position(slot))
+            self.key_file.write(self.key_persist.to_bytes(key) + self.entry.pack(block, 0, 0))
+
+            self.key_header.count += 1
+            self.key_header.write()
 
-                if file_key == None:
-                    # Our slot is empty, write the key here
-                    self.key_file.seek(file_position)
-                    self.key_file.write(self.key_persist.to_bytes(key))
-                    value_index = self.insert_value_new(key, value)
+            if self.terms:
+                self.add_term(self.key_persist.to_bytes(key).rstrip(b'\0'))
+        elif entry[0] == self.NO_BLOCK:
+            # The key only has a run, start its chain
+            block = self.insert_value_new(key, value)
 
-                    self.key_file.write(struct.pack('I', value_index))
-                    self.index_cache[key] = value_index
-                    break
+            self.key_file.seek(self.slot_position(slot) + self.key_persist.data_size)
+            self.key_file.write(self.entry.pack(block, entry[1], entry[2]))
+        else:
+            self.insert_value_old(key, value, entry[0])
 
-            file_position += self.key_persist.data_size + 4
+    # Returns how many slots the directory has
+    def capacity(self):
+        return self.key_header.extra[0]
+
+    def slot_position(self, slot):
+        return HEADER.size + slot * self.slot_size
+
+    # Keys are hashed as they're stored, so moving them around doesn't
+    # need decoding them
+    def hash(self, key_bytes):
+        return zlib.crc32(key_bytes)
+
+    # Looks for a key on the directory, returning its slot and its
+    # (first block, run position, run size). When it's not there, those are
+    # None and the slot is the empty one where it would go
+    def probe(self, key):
+        key_bytes = self.key_persist.to_bytes(key)
+        capacity = self.capacity()
+        slot = self.hash(key_bytes) % capacity
+
+        while True:
+            self.key_file.seek(self.slot_position(slot))
+            arr = self.key_file.read(self.slot_size)
+            file_key = arr[:self.key_persist.data_size]
+
+            if file_key == key_bytes:
+                return slot, self.entry.unpack_from(arr, self.key_persist.data_size)
+
+            # Slots past the end of the file are empty too
+            if len(arr) < self.slot_size or not any(file_key):
+                return slot, None
+
+            slot = (slot + 1) % capacity
+
+    # Moves every key to a directory of a new capacity, in a single read
+    # and write of the key file
+    def resize(self, capacity):
+        self.key_file.seek(HEADER.size)
+        old = self.key_file.read(self.capacity() * self.slot_size)
+
+        slots = [old[start:start + self.slot_size] for start in range(0, len(old), self.slot_size)]
+        self.write_directory([slot for slot in slots if any(slot[:self.key_persist.data_size])], capacity)
+
+    # Writes a directory of a given capacity holding the given slots
+    def write_directory(self, slots, capacity):
+        directory = bytearray(capacity * self.slot_size)
+        used = bytearray(capacity)
+
+        for arr in slots:
+            slot = self.hash(arr[:self.key_persist.data_size]) % capacity
+            while used[slot]:
+                slot = (slot + 1) % capacity
+
+            used[slot] = 1
+            directory[slot * self.slot_size:(slot + 1) * self.slot_size] = arr
+
+        self.key_file.seek(HEADER.size)
+        self.key_file.write(directory)
+
+        self.key_header.extra[0] = capacity
+        self.key_header.write()
+
+    # Returns how full the directory is, and how many slots are probed to
+    # find its keys
+    def stats(self):
+        capacity = self.capacity()
+        probes = []
+
+        self.key_file.seek(HEADER.size)
+        directory = self.key_file.read(capacity * self.slot_size)
+
+        for start in range(0, len(directory), self.slot_size):
+            key_bytes = directory[start:start + self.key_persist.data_size]
+            if any(key_bytes):
+                slot = start // self.slot_size
+                probes.append((slot - self.hash(key_bytes)) % capacity + 1)
+
+        return {
+            'keys': self.key_header.count,
+            'capacity': capacity,
+            'load': len(probes) / capacity if capacity > 0 else 0,
+            'mean_probe': sum(probes) / len(probes) if len(probes) > 0 else 0,
+            'max_probe': max(probes, default=0),
+        }
+
+    # Returns the position of the index-th (0-based) block in the values file
+    def block_position(self, index):
+        return HEADER.size + index * self.block_bytes
 
     # Inserts a new value into the values file
     def insert_value_new(self, key, value):
-        # Go to the end
-        self.value_file.seek(0, 2)
         # Save the new list index
-        index = int(self.value_file.tell() / (self.value_persist.data_size * self.block_size + 4))
-
-        # Make sure we got a valid index
-        assert self.value_file.tell() % (self.value_persist.data_size * self.block_size + 4) == 0
+        index = self.value_header.count
 
         # Cache this block's location
-        self.insert_index_cache[key] = index
+        self.insert_index_cache.put(key, index)
 
         # Save the value
+        self.value_file.seek(self.block_position(index))
         self.value_file.write(self.value_persist.to_bytes(value))
 
         # Write the rest of the values as empty
@@ -123,13 +771,16 @@ class InvertedIndexFile():
         # Write the pointer to the next block as 0
         self.value_file.write(struct.pack('I', 0))
 
+        self.value_header.count += 1
+        self.value_header.write()
+
         return index
 
     def insert_value_old(self, key, value, index):
 
         while True:
             # Go to the start of the list
-            self.value_file.seek(index * (self.value_persist.data_size * self.block_size + 4))
+            self.value_file.seek(self.block_position(index))
 
             for i in range(self.block_size):
                 v = self.value_persist.from_bytes(self.value_file.read(self.value_persist.data_size))
@@ -139,7 +790,7 @@ class InvertedIndexFile():
                     self.value_file.seek(-self.value_persist.data_size, 1)
                     self.value_file.write(self.value_persist.to_bytes(value))
                     # Cache this block's location
-                    self.insert_index_cache[key] = index
+                    self.insert_index_cache.put(key, index)
                     return
 
             # We have read the entire block and found no free slots,
@@ -158,51 +809,99 @@ class InvertedIndexFile():
 
                 return
 
-    # Returns the index a key points to. -1 when key not found
+    # Returns where the list of a key is (see probe). None when key not found
     def find_key(self, key):
         # Try to find it in the cache
-        if key in self.index_cache:
-            return self.index_cache[key]
+        entry = self.index_cache.get(key)
+        if entry != None:
+            return entry
+
+        if self.capacity() == 0:
+            return None
 
         # Locate the key in the file
-        file_position = self.hash_key(key) * (self.key_persist.data_size + 4)
+        _, entry = self.probe(key)
 
-        while True:
-            self.key_file.seek(file_position)
-            arr = self.key_file.read(self.key_persist.data_size)
+        if entry != None:
+            self.index_cache.put(key, entry)
+
+        return entry
+
+    def get_values(self, key):
+        entry = self.find_key(key)
+
+        if entry != None:
+            return self.get_posting_values(entry)
+
+        return []
+
+    # Returns the values of a key as a PostingList, which can be
+    # intersected with others without decoding all of it
+    def get_postings(self, key):
+        entry = self.find_key(key)
+
+        if entry == None:
+            return PostingList()
+
+        index, position, size = entry
+
+        if index != self.NO_BLOCK:
+            # Values inserted after the run was written, which we have to
+            # read anyway, so build a new list
+            return PostingList.from_values(*self.read_sorted_list(entry))
+
+        return PostingList(self.read_run(position, size))
+
+    def read_run(self, position, size):
+        if size == 0:
+            return b''
+
+        self.runs_file.seek(HEADER.size + position)
 
-            if len(arr) == 0:
-                # Got to the end of the file and have not yet found the key.
-                return -1
+        return self.runs_file.read(size)
+
+    def get_posting_values(self, entry):
+        return self.read_list(entry)[0]
+
+    # Returns the values of a list, and their frequencies (None when the
+    # index doesn't keep them)
+    def read_list(self, entry):
+        index, position, size = entry
+
+        run = PostingList(self.read_run(position, size))
+        values = run.values()
+        frequencies = run.frequencies() if self.frequencies else None
+
+        if index == self.NO_BLOCK:
+            return values, frequencies
+
+        for v in self.read_chain(index):
+            if self.frequencies:
+                values.append(v[0])
+                frequencies.append(v[1])
             else:
-                # Check if we found our key, or if this slot is empty
-                file_key = self.key_persist.from_bytes(arr)
+                values.append(v)
 
-                if file_key == key:
-                    # Found our key
-                    index = struct.unpack('I', self.key_file.read(4))[0]
-                    self.index_cache[key] = index
-                    return index
-                elif file_key == None:
-                    # Empty slot, the key is not on this file
-                    return -1
+        return values, frequencies
 
-            file_position += self.key_persist.data_size + 4
+    # Same as read_list, sorting the values
+    def read_sorted_list(self, entry):
+        values, frequencies = self.read_list(entry)
 
-    def get_values(self, key):
-        index = self.find_key(key)
+        if frequencies == None:
+            return sorted(values), None
 
-        if index >= 0:
-            return self.get_posting_values(index)
+        pairs = sorted(zip(values, frequencies))
 
-        return []
+        return [v for v, _ in pairs], [f for _, f in pairs]
 
-    def get_posting_values(self, index):
+    # Returns the items of a chain of blocks
+    def read_chain(self, index):
         res = []
 
         while True:
             # Go to the start of the list
-            self.value_file.seek(index * (self.value_persist.data_size * self.block_size + 4))
+            self.value_file.seek(self.block_position(index))
 
             for i in range(self.block_size):
                 v = self.value_persist.from_bytes(self.value_file.read(self.value_persist.data_size))
@@ -220,24 +919,328 @@ class InvertedIndexFile():
                 # End of the list
                 return res
 
+    # Adds to the length of a value
+    def add_length(self, value, frequency):
+        count = self.lengths_header.count
+        self.lengths_cache = None
+
+        if value >= count:
+            # Values in between have no length yet
+            self.lengths_file.seek(HEADER.size + count * 4)
+            self.lengths_file.write(bytes((value - count) * 4) + struct.pack('I', frequency))
+            self.lengths_header.count = value + 1
+        else:
+            self.lengths_file.seek(HEADER.size + value * 4)
+            length = struct.unpack('I', self.lengths_file.read(4))[0]
+            self.lengths_file.seek(HEADER.size + value * 4)
+            self.lengths_file.write(struct.pack('I', length + frequency))
+
+        self.lengths_header.extra[0] += frequency
+        self.lengths_header.write()
+
+    # Returns the lengths of all values, indexed by value
+    def lengths(self):
+        if self.lengths_cache == None:
+            self.lengths_cache = array('I')
+            self.lengths_file.seek(HEADER.size)
+            self.lengths_cache.frombytes(self.lengths_file.read(self.lengths_header.count * 4))
+
+        return self.lengths_cache
+
+    # Returns the average length of the values that have one
+    def average_length(self):
+        if self.lengths_header.count == 0:
+            return 0
+
+        return self.lengths_header.extra[0] / self.lengths_header.count
+
+    # Writes the terms and grams files, from the bytes of every key, sorted
+    def write_terms(self, keys):
+        terms = [key.rstrip(b'\0') for key in keys]
+        data = encode_terms(terms)
+        grams = encode_grams(terms)
+
+        self.terms_header.reset(self.key_header.generation)
+        self.terms_file.seek(HEADER.size)
+        self.terms_file.write(data)
+        self.terms_header.count = len(data)
+        self.terms_header.extra[0] = len(keys)
+        self.terms_header.write()
+
+        self.grams_header.reset(self.key_header.generation)
+        self.grams_file.seek(HEADER.size)
+        self.grams_file.write(grams)
+        self.grams_header.count = len(grams)
+        self.grams_header.write()
+
+        self.terms_cache = None
+        self.grams_cache = None
+        self.added = []
+
+    # Keeps the bytes of a new key until the terms file is written again
+    def add_term(self, term):
+        insort(self.added, term)
+
+        if len(self.added) >= ADDED_TERMS:
+            self.write_added_terms()
+
+    # Writes the terms file again, with the added keys
+    def write_added_terms(self):
+        self.write_terms(list(heapq.merge(self.term_dictionary().terms(), self.added)))
+
+    # Returns the TermDictionary of the keys in the terms file. It's written
+    # again first when keys are missing from both it and the added ones,
+    # which happens when the index wasn't closed after adding them
+    def term_dictionary(self):
+        if self.terms_header.extra[0] + len(self.added) != self.key_header.count:
+            self.key_file.seek(HEADER.size)
+            directory = self.key_file.read(self.capacity() * self.slot_size)
+
+            keys = [directory[start:start + self.key_persist.data_size] for start in range(0, len(directory), self.slot_size)]
+            self.write_terms(sorted(key for key in keys if any(key)))
+
+        if self.terms_cache == None:
+            self.terms_file.seek(HEADER.size)
+            self.terms_cache = TermDictionary(self.terms_file.read(self.terms_header.count))
+
+        return self.terms_cache
+
+    # Returns the keys that start with prefix, in order, at most `limit`
+    # of them
+    def prefix(self, prefix, limit=None):
+        prefix = prefix.encode('utf-8')
+        terms = self.term_dictionary().prefix(prefix, limit)
+
+        added = []
+        for term in self.added[bisect_left(self.added, prefix):]:
+            if not term.startswith(prefix) or len(added) == limit:
+                break
+
+            added.append(term)
+
+        return [decode(term) for term in list(heapq.merge(terms, added))[:limit]]
+
+    # Returns the trigram index of every key (see term_dictionary)
+    def gram_index(self):
+        # Written along with the dictionary
+        self.term_dictionary()
+
+        if self.grams_cache == None:
+            self.grams_file.seek(HEADER.size)
+            self.grams_cache = GramIndex(self.grams_file.read(self.grams_header.count))
+
+        return self.grams_cache
 
-    def delete(self):
-        self.value_file.seek(0)
-        self.value_file.truncate()
-        self.key_file.seek(0)
-        self.key_file.truncate()
-        self.index_cache = {}
-        self.insert_index_cache = {}
+    # Returns the keys within `distance` edits of a string, as
+    # (distance, key) pairs from the closest
+    def similar(self, string, distance):
+        string = string.encode('utf-8')
+        res = similar_terms(self.term_dictionary(), self.gram_index(), string, distance)
+
+        # Added keys are few, so they're all compared
+        for term in self.added:
+            edits = edit_distance(string, term, distance)
+            if edits <= distance:
+                res.append((edits, term))
+
+        res.sort()
+
+        return [(edits, decode(term)) for edits, term in res]
+
+    # Returns an IndexWriter, to be used as a context manager
+    def bulk_insert(self, budget=INDEX_BUDGET):
+        return IndexWriter(self, budget)
+
+    # Returns how many keys we have
+    def count(self):
+        return self.key_header.count
+
+    def delete(self, generation=None):
+        self.value_header.reset(generation)
+        self.key_header.reset(self.value_header.generation)
+        self.runs_header.reset(self.value_header.generation)
+        self.index_cache.clear()
+        self.insert_index_cache.clear()
+
+        if self.frequencies:
+            self.lengths_header.reset(self.value_header.generation)
+            self.lengths_cache = None
+
+        if self.terms:
+            self.terms_header.reset(self.value_header.generation)
+            self.grams_header.reset(self.value_header.generation)
+            self.terms_cache = None
+            self.grams_cache = None
+            self.added = []
 
     def close(self):
+        if self.added:
+            self.write_added_terms()
+
         self.value_file.close()
         self.key_file.close()
+        self.runs_file.close()
+
+        if self.frequencies:
+            self.lengths_file.close()
+
+        if self.terms:
+            self.terms_file.close()
+            self.grams_file.close()
+
+
+class IndexWriter():
+    # Fills an empty InvertedIndexFile in two phases. Inserted (key, value,
+    # frequency) items are kept in memory, and once there are `budget` of them they're sorted
+    # and spilled to a file next to the index. On flush, which happens when
+    # leaving the `with` block, the spilled runs and the pairs still in
+    # memory are merged, and every list is written once as a run on the
+    # runs file, followed by the whole directory. Keys come
+    # out of the merge sorted, so the terms file is written along
+    def __init__(self, index, budget=INDEX_BUDGET):
+        self.index = index
+        self.budget = budget
+        self.pairs = []
+        self.spills = []
+
+        # Spilled items are stored as the key's bytes, the value and its frequency
+        self.record = struct.Struct(f'{index.key_persist.data_size}sII')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def insert(self, key, value, frequency=1):
+        self.pairs.append((self.index.key_persist.to_bytes(key), value, frequency))
+
+        if len(self.pairs) >= self.budget:
+            self.spill()
+
+    def spill(self):
+        self.pairs.sort()
+
+        filename = f'{self.index.key_file.name}.spill{len(self.spills)}'
+        with open(filename, 'wb') as file:
+            buffer = bytearray()
+
+            for pair in self.pairs:
+                buffer += self.record.pack(*pair)
+
+                if len(buffer) >= WRITE_BUFFER:
+                    file.write(buffer)
+                    buffer = bytearray()
+
+            file.write(buffer)
+
+        self.spills.append(filename)
+        self.pairs = []
+
+    # Yields the pairs of a spilled run, reading it in large chunks
+    def read_spill(self, filename):
+        chunk = max(1, WRITE_BUFFER // self.record.size) * self.record.size
+
+        with open(filename, 'rb') as file:
+            while True:
+                buffer = file.read(chunk)
+
+                if len(buffer) == 0:
+                    return
+
+                yield from self.record.iter_unpack(buffer)
+
+    def flush(self):
+        index = self.index
+        assert index.count() == 0
+
+        self.pairs.sort()
+        merged = heapq.merge(self.pairs, *[self.read_spill(filename) for filename in self.spills])
 
+        slots = []
+        buffer = bytearray()
+        position = 0
+        lengths = array('I')
 
-class Uint32Persist:
+        index.runs_file.seek(HEADER.size)
+
+        for key_bytes, pairs in groupby(merged, key=lambda pair: pair[0]):
+            pairs = list(pairs)
+            values = [value for _, value, _ in pairs]
+
+            if index.frequencies:
+                frequencies = [frequency for _, _, frequency in pairs]
+                run = encode_run(values, frequencies)
+
+                for value, frequency in zip(values, frequencies):
+                    if value >= len(lengths):
+                        lengths.extend([0] * (value + 1 - len(lengths)))
+                    lengths[value] += frequency
+            else:
+                run = encode_run(values)
+
+            slots.append(key_bytes + index.entry.pack(index.NO_BLOCK, position, len(run)))
+            buffer += run
+            position += len(run)
+
+            if len(buffer) >= WRITE_BUFFER:
+                index.runs_file.write(buffer)
+                buffer = bytearray()
+
+        index.runs_file.write(buffer)
+        index.runs_header.count = position
+        index.runs_header.write()
+
+        capacity = index.CAPACITY
+        while len(slots) > capacity * index.MAX_LOAD:
+            capacity *= 2
+
+        index.key_header.count = len(slots)
+        index.write_directory(slots, capacity)
+        index.index_cache.clear()
+        index.insert_index_cache.clear()
+
+        if index.terms:
+            index.write_terms([slot[:index.key_persist.data_size] for slot in slots])
+
+        if index.frequencies:
+            index.lengths_file.seek(HEADER.size)
+            index.lengths_file.write(lengths.tobytes())
+            index.lengths_header.count = len(lengths)
+            index.lengths_header.extra[0] = sum(lengths)
+            index.lengths_header.write()
+            index.lengths_cache = None
+
+        for filename in self.spills:
+            os.remove(filename)
+
+        self.pairs = []
+        self.spills = []
+
+class Persist():
+    # Base for every codec. The pattern of a record is compiled once, and
+    # subclasses implement to_bytes and from_raw, which turns the values
+    # unpacked from a record into the item we hand out
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.struct = struct.Struct(pattern)
+        self.data_size = self.struct.size
+
+    def from_bytes(self, arr):
+        assert len(arr) == self.data_size
+
+        return self.from_raw(self.struct.unpack(arr))
+
+    # Unpacks every record of a buffer holding several of them, one after the other
+    def unpack_many(self, buffer):
+        return self.struct.iter_unpack(buffer)
+
+    def from_raws(self, raws):
+        return [self.from_raw(raw) for raw in raws]
+
+class Uint32Persist(Persist):
     def __init__(self):
-        self.data_size = 4
-        self.pattern = 'I'
+        super().__init__('I')
 
     def to_bytes(self, number):
         # We can't represent this value
@@ -249,12 +1252,10 @@ class Uint32Persist:
         if number == None:
             number = 0
 
-        return struct.pack(self.pattern, number)
-
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
+        return self.struct.pack(number)
 
-        number = struct.unpack(self.pattern, arr)[0]
+    def from_raw(self, raw):
+        number = raw[0]
 
         if number == 4294967295:
             return 0
@@ -264,271 +1265,318 @@ class Uint32Persist:
 
         return number
 
-class Uint32PairPersist:
+class Uint32PairPersist(Persist):
     def __init__(self):
-        self.data_size = 4 * 2
-        self.pattern = 'II'
+        super().__init__('II')
 
     def to_bytes(self, obj):
         if obj == None:
-            return bytes([0] * self.data_size)
+            return bytes(self.data_size)
 
         a, b = obj
 
         # Make sure we can represent this object
         assert a != 0 or b != 0
 
-        return struct.pack(self.pattern, a, b)
+        return self.struct.pack(a, b)
 
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
-
-        pair = struct.unpack(self.pattern, arr)
-
-        if pair == (0, 0):
+    def from_raw(self, raw):
+        if raw == (0, 0):
             return None
 
-        return pair
+        return raw
 
 
-class GamePersist:
-    def __init__(self):
-        self.name_limit = 128
-        self.description_limit = 4096
-
-        self.data_size = 4 * 2 + self.name_limit + self.description_limit + 4 * 5
-        self.pattern = f'II{self.name_limit}s{self.description_limit}sIIIII'
-
-    def to_bytes(self, game):
-        if game == None:
-            return bytes([0] * self.data_size)
-
-        return struct.pack(
-            self.pattern,
-            game['id'],
-            game['year'],
-            limit(game['name'], self.name_limit),
-            limit(game['description'], self.description_limit),
-            game['min_players'],
-            game['max_players'],
-            game['min_playtime'],
-            game['max_playtime'],
-            game['min_age']
-        )
-
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
+# Types of the fields of a record. Each of them has the pattern of the field
+# and how many values it unpacks to, and converts between those values
+# and the field's value. The record's codec is handed to them, so
+# they can reach its heap
+class Uint32Field():
+    pattern = 'I'
+    values = 1
 
-        # Check for empty value
-        if sum(arr) == 0:
-            return None
+    def encode(self, value, persist):
+        return (value,)
 
-        game = {}
+    def decode(self, values, persist):
+        return values[0]
 
-        game['id'], game['year'], game['name'], game['description'], game['min_players'], game['max_players'], game[
-            'min_playtime'], game['max_playtime'], game['min_age'] = struct.unpack(self.pattern, arr)
+    # Maps a value to an unsigned integer with the same order, for indexes
+    def sort_key(self, value):
+        return value
 
-        game['name'] = decode(game['name'])
-        game['description'] = decode(game['description'])
+# Zero is stored as None
+class OptionalUint32Field(Uint32Field):
+    def encode(self, value, persist):
+        return (value if value != None else 0,)
 
-        return game
+    def decode(self, values, persist):
+        return values[0] if values[0] != 0 else None
 
-class PublisherPersist():
-    def __init__(self):
-        self.name_limit = 128
-        self.description_limit = 2048
+class OptionalFloatField(OptionalUint32Field):
+    pattern = 'f'
 
-        self.data_size = 4 + self.name_limit + self.description_limit
-        self.pattern = f'I{self.name_limit}s{self.description_limit}s'
-
-    def to_bytes(self, publisher):
-        if publisher == None:
-            return bytes([0] * self.data_size)
-
-        return struct.pack(
-            self.pattern,
-            publisher['id'],
-            limit(publisher['name'], self.name_limit),
-            limit(publisher['description'], self.description_limit)
-        )
-
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
-
-        # Check for empty value
-        if sum(arr) == 0:
-            return None
+    # The bits of a float sort like the float itself once the sign bit is
+    # flipped for positive numbers, and every bit is for negative ones
+    def sort_key(self, value):
+        bits = struct.unpack('I', struct.pack('f', value))[0]
 
-        publisher = {}
+        if bits & 0x80000000:
+            return bits ^ 0xFFFFFFFF
 
-        publisher['id'], publisher['name'], publisher['description'] = struct.unpack(self.pattern, arr)
+        return bits | 0x80000000
 
-        publisher['name'] = decode(publisher['name'])
-        publisher['description'] = decode(publisher['description'])
+# Text truncated to fit in `limit` bytes
+class TextField():
+    values = 1
 
-        return publisher
+    def __init__(self, limit):
+        self.limit = limit
+        self.pattern = f'{limit}s'
 
-class CommentPersist():
-    def __init__(self):
-        self.text_limit = 512
+    def encode(self, value, persist):
+        return (limit(value, self.limit),)
 
-        self.data_size = 4 + self.text_limit + 4 + 4 * 2
-        self.pattern = f'I{self.text_limit}sfII'
+    def decode(self, values, persist):
+        return decode(values[0])
 
-    def to_bytes(self, comment):
-        if comment == None:
-            return bytes([0] * self.data_size)
+# Text of any size, stored in the codec's heap. The record
+# only holds its reference there
+class HeapTextField():
+    pattern = 'II'
+    values = 2
 
-        rating = comment['rating'] if comment['rating'] != None else 0
+    def encode(self, value, persist):
+        return persist.heap.append(value.encode('utf-8'))
 
-        game_id = comment['game_id']
-        if game_id == None:
-            game_id = 0
+    def decode(self, values, persist):
+        return persist.heap.read(*values).decode('utf-8')
 
-        expansion_id = comment['expansion_id']
-        if expansion_id == None:
-            expansion_id = 0
 
-        # Make sure its a valid comment
-        assert expansion_id != 0 or game_id != 0
+class LazyRecord():
+    # A record that only decodes a field the first time it is accessed.
+    # Behaves like a (read-only) dict
+    def __init__(self, persist, raw):
+        self.persist = persist
+        self.raw = raw
+        self.values = {}
 
-        return struct.pack(
-            self.pattern,
-            comment['id'],
-            limit(comment['text'], self.text_limit),
-            rating,
-            game_id,
-            expansion_id,
-        )
+    def __getitem__(self, field):
+        if field not in self.values:
+            self.values[field] = self.persist.decode_field(self.raw, field)
 
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
+        return self.values[field]
 
-        # Check for empty value
-        if sum(arr) == 0:
-            return None
+    def __contains__(self, field):
+        return field in self.persist.layout
 
-        comment = {}
+    def __iter__(self):
+        return iter(self.persist.layout)
 
-        comment['id'], comment['text'], comment['rating'], comment['game_id'], comment['expansion_id'] = struct.unpack(self.pattern, arr)
+    def get(self, field, default=None):
+        if field not in self:
+            return default
 
-        comment['text'] = decode(comment['text'])
-        if comment['rating'] == 0:
-            comment['rating'] = None
+        return self[field]
 
-        if comment['game_id'] == 0:
-            comment['game_id'] = None
+    def keys(self):
+        return self.persist.layout.keys()
 
-        if comment['expansion_id'] == 0:
-            comment['expansion_id'] = None
+    def items(self):
+        return [(field, self[field]) for field in self]
 
-        return comment
+    def __repr__(self):
+        return repr(dict(self.items()))
 
-class ExpansionPersist():
-    def __init__(self):
-        self.name_limit = 128
-        self.description_limit = 4096
 
-        self.data_size = 4 + self.name_limit + self.description_limit + 4
-        self.pattern = f'I{self.name_limit}s{self.description_limit}sI'
+class RecordPersist(Persist):
+    # Codec generated from the schema of a record: a list of (name, field)
+    # pairs, with fields from the types above.
+    # The first field must be the record's id, which is never zero
+    schema = []
 
-    def to_bytes(self, expansion):
-        if expansion == None:
-            return bytes([0] * self.data_size)
+    def __init__(self, heap=None):
+        self.heap = heap
 
-        return struct.pack(
-            self.pattern,
-            expansion['id'],
-            limit(expansion['name'], self.name_limit),
-            limit(expansion['description'], self.description_limit),
-            expansion['year']
-        )
+        # Maps each field to its type, and where its values are in an unpacked record
+        self.layout = {}
+        # Fields whose contents are stored in the heap
+        self.heap_fields = []
 
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
+        start = 0
+        for name, field in self.schema:
+            self.layout[name] = (field, start, start + field.values)
+            start += field.values
 
-        # Check for empty value
-        if sum(arr) == 0:
-            return None
+            if isinstance(field, HeapTextField):
+                self.heap_fields.append(name)
 
-        expansion = {}
+        super().__init__(''.join(field.pattern for name, field in self.schema))
 
-        expansion['id'], expansion['name'], expansion['description'], expansion['year'] = struct.unpack(self.pattern, arr)
+    def to_bytes(self, record):
+        if record == None:
+            return bytes(self.data_size)
 
-        expansion['name'] = decode(expansion['name'])
-        expansion['description'] = decode(expansion['description'])
+        values = []
+        for name, field in self.schema:
+            values.extend(field.encode(record[name], self))
 
-        return expansion
+        return self.struct.pack(*values)
 
+    # Decodes a record. When `fields` is given, only those fields are decoded
+    # and a dict is returned. Otherwise we return a LazyRecord
+    def from_bytes(self, arr, fields=None):
+        assert len(arr) == self.data_size
 
-class TagPersist():
-    # Persists both categories and mechanics
-    def __init__(self):
-        self.name_limit = 32
-        self.data_size = 4 + self.name_limit
-        self.pattern = f'I{self.name_limit}s'
+        return self.from_raws([self.struct.unpack(arr)], fields)[0]
 
-    def to_bytes(self, tag):
-        if tag == None:
-            return bytes([0] * self.data_size)
+    def from_raw(self, raw):
+        return self.from_raws([raw])[0]
 
-        return struct.pack(self.pattern, tag['id'], limit(tag['name'], self.name_limit))
+    # Decodes several unpacked records at once. When decoding only some `fields`,
+    # the ones stored in the heap are fetched for all records in a single batch
+    def from_raws(self, raws, fields=None):
+        if fields == None:
+            # Empty records have a zero id
+            return [LazyRecord(self, raw) if raw[0] != 0 else None for raw in raws]
 
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
+        records = []
+        for raw in raws:
+            if raw[0] == 0:
+                records.append(None)
+            else:
+                records.append({field: self.decode_field(raw, field) for field in fields if field not in self.heap_fields})
+
+        for field in fields:
+            if field not in self.heap_fields:
+                continue
+
+            _, start, end = self.layout[field]
+            refs = [raw[start:end] for raw in raws if raw[0] != 0]
+
+            texts = iter(self.heap.read_many(refs))
+            for record in records:
+                if record != None:
+                    record[field] = next(texts).decode('utf-8')
+
+        return records
+
+    def decode_field(self, raw, field):
+        field, start, end = self.layout[field]
+
+        return field.decode(raw[start:end], self)
+
+
+class GamePersist(RecordPersist):
+    schema = [
+        ('id', Uint32Field()),
+        ('year', Uint32Field()),
+        ('name', HeapTextField()),
+        ('description', HeapTextField()),
+        ('min_players', Uint32Field()),
+        ('max_players', Uint32Field()),
+        ('min_playtime', Uint32Field()),
+        ('max_playtime', Uint32Field()),
+        ('min_age', Uint32Field()),
+    ]
+
+class PublisherPersist(RecordPersist):
+    schema = [
+        ('id', Uint32Field()),
+        ('name', HeapTextField()),
+        ('description', HeapTextField()),
+    ]
+
+class CommentPersist(RecordPersist):
+    schema = [
+        ('id', Uint32Field()),
+        ('text', HeapTextField()),
+        ('rating', OptionalFloatField()),
+        ('game_id', OptionalUint32Field()),
+        ('expansion_id', OptionalUint32Field()),
+    ]
 
-        if (sum(arr)) == 0:
-            return None
+    def to_bytes(self, comment):
+        # Make sure its a valid comment
+        assert comment == None or comment['game_id'] != None or comment['expansion_id'] != None
 
-        tag = {}
+        return super().to_bytes(comment)
 
-        tag['id'], tag['name'] = struct.unpack(self.pattern, arr)
-        tag['name'] = decode(tag['name'])
+class ExpansionPersist(RecordPersist):
+    schema = [
+        ('id', Uint32Field()),
+        ('name', HeapTextField()),
+        ('description', HeapTextField()),
+        ('year', Uint32Field()),
+    ]
 
-        return tag
+class TagPersist(RecordPersist):
+    # Persists both categories and mechanics
+    schema = [
+        ('id', Uint32Field()),
+        ('name', TextField(32)),
+    ]
 
-class StringPersist():
+class StringPersist(Persist):
     def __init__(self, limit):
-        self.data_size = limit
-        self.pattern = f"f{limit}s"
+        super().__init__(f'{limit}s')
 
     def to_bytes(self, string):
         # Can't represent this value
         assert string != ''
 
         if string == None:
-            return bytes([0] * self.data_size)
+            return bytes(self.data_size)
 
-        arr = list(string.encode('utf-8'))
+        arr = string.encode('utf-8')
 
         # Make sure it fits
         assert len(arr) <= self.data_size
-        # Fill the remaining slots
-        for i in range(self.data_size - len(arr)):
-            arr.append(0)
 
-        return bytes(arr)
+        # Missing bytes are filled with zeros
+        return self.struct.pack(arr)
 
-    def from_bytes(self, arr):
-        assert len(arr) == self.data_size
-
-        res = decode(arr)
+    def from_raw(self, raw):
+        res = decode(raw[0])
 
         if res == '':
             return None
 
         return res
 
+# Opens a file, reading it through a BufferPool when one is given
+def open_pooled(filename, pool=None):
+    if pool == None:
+        return openfile(filename)
+
+    return pool.open(filename)
+
+# Groups (start, end, item) spans into runs that can be read at once,
+# yielding the (start, end, items) of each run in file order
+def coalesce(spans, max_gap=COALESCE_GAP):
+    run = None
+
+    for start, end, item in sorted(spans, key=lambda span: span[0]):
+        if run != None and start - run[1] <= max_gap:
+            run[1] = max(run[1], end)
+            run[2].append(item)
+        else:
+            if run != None:
+                yield tuple(run)
+            run = [start, end, [item]]
+
+    if run != None:
+        yield tuple(run)
+
 def limit(string, max_size, encoding='utf-8'):
-    string = list(string)
-    arr = ''.join(string).encode(encoding)
+    arr = string.encode(encoding)
 
-    while len(arr) > max_size:
-        # Keep popping until we have a small enough string
-        string.pop()
-        arr = ''.join(string).encode(encoding)
+    if len(arr) <= max_size:
+        return arr
 
-    return arr
+    # Cut the string to size, dropping the last character if it
+    # got split in half
+    return arr[:max_size].decode(encoding, 'ignore').encode(encoding)
 
 
 def decode(bts, encoding='utf-8'):
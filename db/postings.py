@@ -0,0 +1,313 @@
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import heappush, heapreplace, merge
+from itertools import accumulate
+from math import log
+
+# How many values each block of a run holds
+SKIP = 64
+
+# BM25 parameters: how fast term frequency saturates, and how much
+# document length matters
+K1 = 1.2
+B = 0.75
+
+# Runs start with how many values and blocks they have, and whether they
+# hold frequencies
+RUN_HEADER = struct.Struct('III')
+
+# Encodes numbers as varints: 7 bits per byte, with the high bit set on all
+# bytes but the last
+def encode_varints(numbers):
+    res = bytearray()
+
+    for number in numbers:
+        while number >= 0x80:
+            res.append(number & 0x7F | 0x80)
+            number >>= 7
+        res.append(number)
+
+    return res
+
+def decode_varints(bts):
+    res = []
+    number = 0
+    shift = 0
+
+    for byte in bts:
+        if byte & 0x80:
+            number |= (byte & 0x7F) << shift
+            shift += 7
+        else:
+            res.append(number | byte << shift)
+            number = 0
+            shift = 0
+
+    return res
+
+# Encodes a sorted list of numbers as a run: the run header, the first
+# value of every block of SKIP values, where each block starts, and then the
+# blocks. Each block holds the differences between its values as varints,
+# followed by their frequencies when there are any
+def encode_run(numbers, frequencies=None):
+    numbers = list(numbers)
+    firsts = array('I')
+    offsets = array('I')
+    data = bytearray()
+
+    for start in range(0, len(numbers), SKIP):
+        block = numbers[start:start + SKIP]
+
+        firsts.append(block[0])
+        offsets.append(len(data))
+        data += encode_varints(b - a for a, b in zip(block, block[1:]))
+
+        if frequencies != None:
+            data += encode_varints(frequencies[start:start + SKIP])
+
+    header = RUN_HEADER.pack(len(numbers), len(firsts), frequencies != None)
+
+    return header + firsts.tobytes() + offsets.tobytes() + data
+
+
+class PostingList():
+    # A sorted list of values read from a run, which is only decoded a
+    # block at a time, as needed. The first values of the blocks act as
+    # skip pointers, so intersections only decode the blocks that may
+    # hold a value they look for.
+    # Runs without frequencies give every value a frequency of 1
+    def __init__(self, run=b''):
+        run = memoryview(run)
+
+        # Last decoded block, as (number, values, frequencies)
+        self.decoded = None
+
+        if len(run) == 0:
+            self.count = 0
+            self.firsts = []
+            return
+
+        self.count, blocks, self.has_frequencies = RUN_HEADER.unpack_from(run)
+
+        start = RUN_HEADER.size
+        self.firsts = run[start:start + 4 * blocks].cast('I')
+        self.offsets = run[start + 4 * blocks:start + 8 * blocks].cast('I')
+        self.data = run[start + 8 * blocks:]
+
+    # Returns a posting list holding the given sorted values
+    @staticmethod
+    def from_values(values, frequencies=None):
+        return PostingList(encode_run(values, frequencies))
+
+    def __len__(self):
+        return self.count
+
+    # Returns the values of the i-th block, and their frequencies
+    def block(self, i):
+        if self.decoded == None or self.decoded[0] != i:
+            end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.data)
+            size = min(SKIP, self.count - i * SKIP)
+            numbers = decode_varints(self.data[self.offsets[i]:end])
+
+            values = list(accumulate(numbers[:size - 1], initial=self.firsts[i]))
+            frequencies = numbers[size - 1:] if self.has_frequencies else [1] * size
+
+            self.decoded = (i, values, frequencies)
+
+        return self.decoded[1], self.decoded[2]
+
+    def values(self):
+        res = []
+
+        for i in range(len(self.firsts)):
+            res += self.block(i)[0]
+
+        return res
+
+    def frequencies(self):
+        res = []
+
+        for i in range(len(self.firsts)):
+            res += self.block(i)[1]
+
+        return res
+
+    # Returns the last block, from `block` on, that starts at or before a
+    # value, galloping through the skip pointers. -1 when the value is
+    # before every block
+    def seek(self, block, value):
+        step = 1
+        while block + step < len(self.firsts) and self.firsts[block + step] <= value:
+            block += step
+            step *= 2
+
+        return bisect_right(self.firsts, value, block, min(block + step, len(self.firsts))) - 1
+
+    # Returns the values of `candidates` (sorted too) that are on this list.
+    # Few candidates gallop through the skip pointers, decoding only the
+    # blocks they land on, while many are merged with the whole list
+    def intersect(self, candidates):
+        if len(candidates) * 8 > self.count:
+            return intersect_sorted(candidates, self.values())
+
+        res = []
+        block = 0
+
+        for candidate in candidates:
+            block = self.seek(block, candidate)
+
+            if block < 0:
+                block = 0
+                continue
+
+            values = self.block(block)[0]
+            i = bisect_left(values, candidate)
+            if i < len(values) and values[i] == candidate:
+                res.append(candidate)
+
+        return res
+
+
+# Returns the values on both sorted lists, galloping through the longest one
+def intersect_sorted(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+
+    res = []
+    position = 0
+
+    for value in a:
+        step = 1
+        while position + step < len(b) and b[position + step] < value:
+            position += step
+            step *= 2
+        position = bisect_left(b, value, position, min(position + step + 1, len(b)))
+
+        if position == len(b):
+            break
+
+        if b[position] == value:
+            res.append(value)
+
+    return res
+
+# Returns the values on every list, which may be PostingLists or sorted
+# lists. The shortest list goes first, and every other one only has to
+# look for what is left
+def intersect_postings(lists):
+    if len(lists) == 0:
+        return []
+
+    lists = sorted(lists, key=len)
+
+    res = lists[0].values() if isinstance(lists[0], PostingList) else list(lists[0])
+
+    for other in lists[1:]:
+        if len(res) == 0:
+            break
+
+        if isinstance(other, PostingList):
+            res = other.intersect(res)
+        else:
+            res = intersect_sorted(res, other)
+
+    return res
+
+# Returns the values on any of the lists, which may be PostingLists or
+# sorted lists, sorted and without repeats
+def union_postings(lists):
+    lists = [other.values() if isinstance(other, PostingList) else other for other in lists]
+    res = []
+
+    for value in merge(*lists):
+        if len(res) == 0 or res[-1] != value:
+            res.append(value)
+
+    return res
+
+# Returns the `k` values that score best with BM25 for the terms whose
+# posting lists are given, as (value, score) pairs from the best down.
+# `lengths` holds the length of every value's document, and `documents`
+# how many documents there are. When `allowed` is given, only the values in
+# it are ranked.
+# Terms are scored MaxScore style: no term can add more than
+# idf * (K1 + 1) to a score, so once the top k are good enough, the terms
+# with the lowest bounds can't take a document there on their own. Only
+# documents on the other lists are considered, and the low terms are only
+# looked up for documents that can still make it
+def rank_bm25(postings, lengths, average_length, documents, k, allowed=None):
+    terms = []
+
+    for posting in postings:
+        if len(posting) == 0:
+            continue
+
+        idf = log(1 + (documents - len(posting) + 0.5) / (len(posting) + 0.5))
+        terms.append((idf * (K1 + 1), idf, posting))
+
+    if len(terms) == 0 or k <= 0:
+        return []
+
+    terms.sort(key=lambda term: term[0])
+    # Bound of the scores given by terms[0] to terms[i]
+    bounds = list(accumulate(term[0] for term in terms))
+
+    # Values and frequencies of each term, and where we are on them
+    lists = [(posting.values(), posting.frequencies()) for _, _, posting in terms]
+
+    # Terms keep the idf of all their documents, even when only some of
+    # them may be ranked
+    if allowed != None:
+        for i, (values, frequencies) in enumerate(lists):
+            kept = [j for j, value in enumerate(values) if value in allowed]
+            lists[i] = ([values[j] for j in kept], [frequencies[j] for j in kept])
+    positions = [0] * len(terms)
+    # terms[first:] can bring in documents
+    first = 0
+
+    heap = []
+    threshold = 0
+
+    while True:
+        candidates = [lists[i][0][positions[i]] for i in range(first, len(terms)) if positions[i] < len(lists[i][0])]
+        if len(candidates) == 0:
+            break
+
+        value = min(candidates)
+        norm = K1 * (1 - B + B * lengths[value] / average_length)
+        score = 0
+
+        for i in range(first, len(terms)):
+            values, frequencies = lists[i]
+
+            if positions[i] < len(values) and values[positions[i]] == value:
+                frequency = frequencies[positions[i]]
+                score += terms[i][1] * frequency * (K1 + 1) / (frequency + norm)
+                positions[i] += 1
+
+        # The other terms, from the highest bound down, while they can still
+        # take the document to the top k
+        for i in range(first - 1, -1, -1):
+            if score + bounds[i] <= threshold:
+                break
+
+            values, frequencies = lists[i]
+            positions[i] = bisect_left(values, value, positions[i])
+
+            if positions[i] < len(values) and values[positions[i]] == value:
+                frequency = frequencies[positions[i]]
+                score += terms[i][1] * frequency * (K1 + 1) / (frequency + norm)
+
+        if len(heap) < k:
+            heappush(heap, (score, value))
+        elif score > heap[0][0]:
+            heapreplace(heap, (score, value))
+
+        if len(heap) == k:
+            threshold = heap[0][0]
+
+            while first < len(terms) and bounds[first] <= threshold:
+                first += 1
+
+    return [(value, score) for score, value in sorted(heap, key=lambda item: (-item[0], item[1]))]
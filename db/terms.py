@@ -0,0 +1,261 @@
+import struct
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from .postings import PostingList, encode_run
+
+# How many terms each block of a term dictionary holds
+TERM_BLOCK = 16
+
+# How long terms can be
+MAX_LENGTH = 255
+
+# Term dictionaries start with how many terms and blocks they have
+TERMS_HEADER = struct.Struct('II')
+
+# Terms are padded with two zero bytes on each side before being split in
+# trigrams, so their ends are in as many trigrams as the rest of them
+PAD = bytes(2)
+
+# Trigram indexes start with how many lists they have, followed by the
+# length of the terms and the trigram of each list, along with where its
+# run starts and its size
+GRAMS_HEADER = struct.Struct('I')
+GRAM = struct.Struct('B3sII')
+
+# Encodes sorted terms (as bytes, each at most MAX_LENGTH long) front coded,
+# in blocks of TERM_BLOCK: the first term of a block is stored whole, and
+# every other one as how many bytes it shares with the one before and the
+# rest of it. Each term is then a byte with the shared bytes and another
+# with the length of the rest, followed by the rest. The blocks come after
+# the header and where each one starts
+def encode_terms(terms):
+    offsets = array('I')
+    data = bytearray()
+    previous = b''
+
+    for i, term in enumerate(terms):
+        if i % TERM_BLOCK == 0:
+            offsets.append(len(data))
+            previous = b''
+
+        assert len(term) <= MAX_LENGTH
+
+        shared = 0
+        while shared < min(len(term), len(previous)) and term[shared] == previous[shared]:
+            shared += 1
+
+        data.append(shared)
+        data.append(len(term) - shared)
+        data += term[shared:]
+        previous = term
+
+    return TERMS_HEADER.pack(len(terms), len(offsets)) + offsets.tobytes() + data
+
+# Returns the trigrams of a term (as bytes), without repeats
+def trigrams(term):
+    term = PAD + term + PAD
+
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+# Encodes a trigram index of sorted terms: for each length of the terms
+# and trigram, the numbers of the terms of that length that have it, as a
+# run (see db.postings)
+def encode_grams(terms):
+    lists = {}
+
+    for i, term in enumerate(terms):
+        for gram in trigrams(term):
+            lists.setdefault((len(term), gram), []).append(i)
+
+    directory = bytearray()
+    runs = bytearray()
+
+    for length, gram in sorted(lists):
+        run = encode_run(lists[(length, gram)])
+        directory += GRAM.pack(length, gram, len(runs), len(run))
+        runs += run
+
+    return GRAMS_HEADER.pack(len(lists)) + directory + runs
+
+# Returns how many edits turn a string into another, where an edit is
+# adding, removing or changing a character, or swapping two adjacent ones
+# (the optimal string alignment distance), or limit + 1 as soon as it's
+# known to be greater than limit
+def edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    before = None
+    previous = list(range(len(b) + 1))
+
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+
+        for j in range(1, len(b) + 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (a[i - 1] != b[j - 1]),
+            )
+
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+
+        if min(current) > limit:
+            return limit + 1
+
+        before = previous
+        previous = current
+
+    return min(previous[-1], limit + 1)
+
+# Returns the terms of a dictionary within `distance` edits of a term, as
+# (distance, term) pairs from the closest. Every edit changes at most four
+# trigrams (three, unless it's a swap), so only terms that share all but
+# 4 * distance of the term's trigrams (and at least one) can be close
+# enough, and only those are compared with it. They're looked for among
+# the terms of close enough lengths
+def similar_terms(dictionary, grams, term, distance):
+    query = trigrams(term)
+    needed = max(1, len(query) - 4 * distance)
+
+    candidates = []
+
+    for length in range(max(1, len(term) - distance), min(len(term) + distance, MAX_LENGTH) + 1):
+        lists = sorted((grams.postings(length, gram) for gram in query), key=len)
+
+        # Terms on `needed` lists are on one of the shortest ones, so only
+        # those are read whole, and the rest only looked up
+        counts = Counter()
+        for posting in lists[:len(lists) - needed + 1]:
+            counts.update(posting.values())
+
+        found = sorted(counts)
+        for posting in lists[len(lists) - needed + 1:]:
+            counts.update(posting.intersect(found))
+
+        candidates += [i for i in found if counts[i] >= needed]
+
+    res = []
+
+    # In order, so terms of the same block are decoded together
+    for i in sorted(candidates):
+        candidate = dictionary.term(i)
+
+        edits = edit_distance(term, candidate, distance)
+        if edits <= distance:
+            res.append((edits, candidate))
+
+    return sorted(res)
+
+class TermDictionary():
+    # The sorted terms of an encoded dictionary (see encode_terms). Only
+    # the first term of every block is decoded up front, so finding where
+    # a term would be is a binary search over them followed by decoding
+    # one block
+    def __init__(self, data=b''):
+        data = memoryview(data)
+
+        # Last decoded block, as (number, terms)
+        self.decoded = None
+
+        if len(data) == 0:
+            self.count = 0
+            self.offsets = []
+            self.heads = []
+            return
+
+        self.count, blocks = TERMS_HEADER.unpack_from(data)
+
+        start = TERMS_HEADER.size
+        self.offsets = data[start:start + 4 * blocks].cast('I')
+        self.data = data[start + 4 * blocks:]
+
+        # First terms have nothing shared
+        self.heads = []
+        for offset in self.offsets:
+            length = self.data[offset + 1]
+            self.heads.append(bytes(self.data[offset + 2:offset + 2 + length]))
+
+    def __len__(self):
+        return self.count
+
+    # Returns the terms of the i-th block
+    def block(self, i):
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.data)
+        data = bytes(self.data[self.offsets[i]:end])
+
+        res = []
+        term = b''
+        position = 0
+
+        while position < len(data):
+            shared = data[position]
+            length = data[position + 1]
+            term = term[:shared] + data[position + 2:position + 2 + length]
+            position += 2 + length
+            res.append(term)
+
+        return res
+
+    # Returns the i-th term
+    def term(self, i):
+        block = i // TERM_BLOCK
+
+        if self.decoded == None or self.decoded[0] != block:
+            self.decoded = (block, self.block(block))
+
+        return self.decoded[1][i % TERM_BLOCK]
+
+    def terms(self):
+        res = []
+
+        for i in range(len(self.offsets)):
+            res += self.block(i)
+
+        return res
+
+    # Returns the terms that start with prefix, in order, at most `limit`
+    # of them. They're all next to each other, from the block where the
+    # prefix would go on
+    def prefix(self, prefix, limit=None):
+        res = []
+        i = max(0, bisect_right(self.heads, prefix) - 1)
+
+        for i in range(i, len(self.offsets)):
+            for term in self.block(i):
+                if term < prefix:
+                    continue
+
+                if not term.startswith(prefix) or len(res) == limit:
+                    return res
+
+                res.append(term)
+
+        return res
+
+
+class GramIndex():
+    # The runs of an encoded trigram index (see encode_grams), found by
+    # the length of their terms and their trigram
+    def __init__(self, data=b''):
+        data = memoryview(data)
+        self.runs = {}
+
+        if len(data) == 0:
+            return
+
+        count, = GRAMS_HEADER.unpack_from(data)
+        start = GRAMS_HEADER.size + count * GRAM.size
+
+        for length, gram, position, size in GRAM.iter_unpack(data[GRAMS_HEADER.size:start]):
+            self.runs[(length, gram)] = data[start + position:start + position + size]
+
+    def __len__(self):
+        return len(self.runs)
+
+    # Returns the numbers of the terms of a length with a trigram, as a
+    # PostingList
+    def postings(self, length, gram):
+        return PostingList(self.runs.get((length, gram), b''))
@@ -4,7 +4,7 @@ import threading
 import queue
 from ui.ui import ui_push, ui_pop
 from db.db import connect
-from utils import tokenize, intersect
+from utils import tokenize
 from .list_item import ListItem
 
 class DBFillScreen:
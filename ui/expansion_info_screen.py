@@ -1,7 +1,7 @@
 import py_cui
 from ui.ui import ui_push
 from db.db import connect
-from utils import tokenize, intersect
+from utils import tokenize
 from .list_item import ListItem
 
 class ExpansionInfoScreen:
@@ -27,7 +27,7 @@ class ExpansionInfoScreen:
         text = ''
         total = 0
         count = 0
-        for comment in db.get_by_posting('comments', 'expansion', self.id):
+        for comment in db.get_by_posting('comments', 'expansion', self.id, ['text', 'rating']):
             if comment['rating'] != None:
                 text += f"{comment['rating']}/10 - "
                 total += comment['rating']
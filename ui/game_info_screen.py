@@ -31,29 +31,29 @@ class GameInfoScreen:
         self.categories.add_key_command(py_cui.keys.KEY_ENTER, self.select_category)
         self.mechanics.add_key_command(py_cui.keys.KEY_ENTER, self.select_mechanic)
 
-        for _, pub_id in db.get_by_posting('game_publisher', 'game', self.id):
-            publisher = db.get_by_key('publishers', pub_id)
+        pub_ids = [pub_id for _, pub_id in db.get_by_posting('game_publisher', 'game', self.id)]
+        for publisher in db.get_many_by_key('publishers', pub_ids, ['id', 'name']):
             item = ListItem(publisher, publisher['name'])
             self.publishers.add_item(item)
 
-        for _, cat_id in db.get_by_posting('game_category', 'game', self.id):
-            category = db.get_by_key('categories', cat_id)
+        cat_ids = [cat_id for _, cat_id in db.get_by_posting('game_category', 'game', self.id)]
+        for category in db.get_many_by_key('categories', cat_ids, ['id', 'name']):
             item = ListItem(category['id'], category['name'])
             self.categories.add_item(item)
 
-        for _, mech_id in db.get_by_posting('game_mechanic', 'game', self.id):
-            mechanic = db.get_by_key('mechanics', mech_id)
+        mech_ids = [mech_id for _, mech_id in db.get_by_posting('game_mechanic', 'game', self.id)]
+        for mechanic in db.get_many_by_key('mechanics', mech_ids, ['id', 'name']):
             item = ListItem(mechanic['id'], mechanic['name'])
             self.mechanics.add_item(item)
 
-        for expansion in db.get_by_posting('expansions', 'game', self.id):
+        for expansion in db.get_by_posting('expansions', 'game', self.id, ['id', 'name']):
             item = ListItem(expansion, expansion['name'])
             self.expansions.add_item(item)
 
         text = ''
         total = 0
         count = 0
-        for comment in db.get_by_posting('comments', 'game', self.id):
+        for comment in db.get_by_posting('comments', 'game', self.id, ['text', 'rating']):
             if comment['rating'] != None:
                 text += f"{comment['rating']}/10 - "
                 total += comment['rating']
@@ -93,7 +93,10 @@ Playtime:
         if exp == None:
             return
 
-        ui_push(self.ui, eis.ExpansionInfoScreen(self.ui, exp.value))
+        # The listing only holds the expansion's name, load all of it
+        expansion = connect().get_by_key('expansions', exp.value['id'])
+
+        ui_push(self.ui, eis.ExpansionInfoScreen(self.ui, expansion))
 
     def select_category(self):
         cat = self.categories.get()
@@ -117,7 +120,10 @@ Playtime:
         if pub == None:
             return
 
-        ui_push(self.ui, pis.PublisherInfoScreen(self.ui, pub.value))
+        # The listing only holds the publisher's name, load all of it
+        publisher = connect().get_by_key('publishers', pub.value['id'])
+
+        ui_push(self.ui, pis.PublisherInfoScreen(self.ui, publisher))
 
     def apply(self):
         self.ui.set_title(f"{self.game['name']} (#{self.id})")
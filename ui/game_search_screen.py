@@ -2,23 +2,30 @@ import py_cui
 import ui.game_info_screen as gis
 from .list_item import ListItem
 from db.db import connect
-from functools import reduce
-from utils import tokenize, intersect, reduce_intersection, game_rating
-from .ui import ui_push
+from db.postings import intersect_postings, union_postings
+from utils import tokenize, typed_words, game_rating
+from .ui import ui_push, on_change
+
+# How many words are suggested while typing a search
+SUGGESTIONS = 5
 
 class GameSearchScreen():
 
     def __init__(self, ui: py_cui.PyCUI, mechanics = None, categories = None):
         self.categories = categories or []
         self.mechanics = mechanics or []
+        # Conditions on the games' numeric attributes (see parse_filters)
+        self.conditions = []
         self.reversed = False
+        # Whether text searches are ordered by relevance instead of rating
+        self.ranked = False
 
         self.ui = ui
         self.root = ui.create_new_widget_set(3, 3)
 
         self.search_box = self.root.add_text_box('Search 🔍', 0, 0)
         self.result_list = self.root.add_scroll_menu('Results 🕮', 2, 0, column_span=2)
-        self.result_list.set_help_text('Press "r" to reverse the order')
+        self.result_list.set_help_text('Press "r" to reverse the order, "o" to order by relevance or rating')
 
         self.mechanics_search = self.root.add_text_box('Mechanics 🔍', 0, 1)
         self.mechanics_result = self.root.add_checkbox_menu('Mechanics ⚙️', 0, 2)
@@ -26,17 +33,27 @@ class GameSearchScreen():
         self.categories_search = self.root.add_text_box('Categories 🔍', 1, 2)
         self.categories_result = self.root.add_checkbox_menu('Categories 📚', 2, 2)
 
+        self.filters_search = self.root.add_text_box('Players / Time / Year / Age 🔍', 1, 1)
+        self.filters_search.set_help_text('E.g.: "players 3-5 time 60 year 2010-2020 age 12"')
+
         self.search_box.add_key_command(py_cui.keys.KEY_ENTER, self.search)
+        self.filters_search.add_key_command(py_cui.keys.KEY_ENTER, self.select_filters)
         self.mechanics_search.add_key_command(py_cui.keys.KEY_ENTER, self.search_mechanics)
         self.categories_search.add_key_command(py_cui.keys.KEY_ENTER, self.search_categories)
 
+        # Words are completed as they're typed
+        on_change(self.search_box, self.suggest)
+        on_change(self.mechanics_search, lambda: self.search_mechanics(typing=True))
+        on_change(self.categories_search, lambda: self.search_categories(typing=True))
+
         self.categories_result.add_key_command(py_cui.keys.KEY_ENTER, self.select_category)
         self.mechanics_result.add_key_command(py_cui.keys.KEY_ENTER, self.select_mechanic)
 
         self.result_list.add_key_command(py_cui.keys.KEY_ENTER, self.select_result)
         self.result_list.add_key_command(py_cui.keys.KEY_R_LOWER, self.reverse)
+        self.result_list.add_key_command(py_cui.keys.KEY_O_LOWER, self.toggle_ranked)
 
-        self.current_filter = self.root.add_block_label('Current Filters 📝', 1, 0, column_span=2, center=False)
+        self.current_filter = self.root.add_block_label('Current Filters 📝', 1, 0, center=False)
 
         self.update_filters_text()
 
@@ -48,53 +65,60 @@ class GameSearchScreen():
         game_ids = None
         mechanics_ids = None
         categories_ids = None
+        attributes_ids = None
 
-        if len(game_search) > 0:
-            ids = []
-            for token in game_search:
-                # Append array of ids
-                ids.append(list(map(
-                    lambda g: g['id'],
-                    db.get_by_posting('games', 'word', token)
-                )))
-
-            game_ids = list(reduce(
-                reduce_intersection,
-                ids
-            ))
+        # Ranked searches rank the games that meet the other criteria (below)
+        ranking = len(game_search) > 0 and self.ranked
+
+        if not ranking and len(game_search) > 0:
+            rows = db.match_words('games', game_search)
+
+            # Nothing has those words, look for the closest ones instead
+            if len(rows) == 0:
+                rows = db.match_similar('games', game_search)
+
+            game_ids = sorted(game['id'] for game in db.tables['games'].load_many(rows, ['id']))
 
         if len(self.mechanics) > 0:
             ids = []
             for mechanic_item in self.mechanics:
                 mechanic_id = mechanic_item.value
-                ids.append(list(map(
-                    lambda tuple: tuple[0],
-                    db.get_by_posting('game_mechanic', 'mechanic', mechanic_id)
-                )))
+                ids.append(sorted(
+                    pair[0] for pair in db.get_by_posting('game_mechanic', 'mechanic', mechanic_id)
+                ))
 
-            mechanics_ids = list(reduce(
-                reduce_intersection,
-                ids
-            ))
+            mechanics_ids = intersect_postings(ids)
 
         if len(self.categories) > 0:
             ids = []
             for category_item in self.categories:
                 category_id = category_item.value
-                ids.append(list(map(
-                    lambda tuple: tuple[0],
-                    db.get_by_posting('game_category', 'category', category_id)
-                )))
+                ids.append(sorted(
+                    pair[0] for pair in db.get_by_posting('game_category', 'category', category_id)
+                ))
+
+            categories_ids = intersect_postings(ids)
+
+        if len(self.conditions) > 0:
+            attributes_ids = sorted(db.filter('games', self.conditions))
 
-            categories_ids = list(reduce(
-                reduce_intersection,
-                ids
-            ))
+        # Only the criteria in use narrow down the results
+        criteria = [ids for ids in [game_ids, mechanics_ids, categories_ids, attributes_ids] if ids != None]
 
+        if ranking:
+            allowed = set(db.find_rows('games', intersect_postings(criteria))) if len(criteria) > 0 else None
+            ranked = db.rank_words('games', game_search, allowed=allowed)
 
-        results = list(intersect(intersect(game_ids, mechanics_ids), categories_ids) or [])
+            # Nothing has those words, look for the closest ones instead
+            if len(ranked) == 0:
+                ranked = db.rank_similar('games', game_search, allowed=allowed)
 
-        self.present_results(results)
+            games = db.tables['games'].load_many([row for row, _ in ranked], ['id', 'name'])
+
+            self.present_ranked([(game, score) for game, (_, score) in zip(games, ranked)])
+            return
+
+        self.present_results(intersect_postings(criteria))
 
     def present_results(self, ids):
         db = connect()
@@ -105,8 +129,7 @@ class GameSearchScreen():
             return
 
         games = []
-        for game_id in ids:
-            game = db.get_by_key('games', game_id)
+        for game in db.get_many_by_key('games', ids, ['id', 'name']):
             games.append((game, game_rating(game, db)))
 
         # Sort by rating or reverse rating (greater first, so we negate reversed)
@@ -118,51 +141,85 @@ class GameSearchScreen():
 
         self.ui.move_focus(self.result_list)
 
+    # Lists (game, score) pairs, from the most relevant down
+    def present_ranked(self, games):
+        self.result_list.clear()
+        if len(games) <= 0:
+            self.result_list.add_item('No items found!')
+            return
+
+        if self.reversed:
+            games = games[::-1]
+
+        for game, score in games:
+            item = ListItem(game, f"[{score:.2f}] - {game['name']}")
+            self.result_list.add_item(item)
+
+        self.ui.move_focus(self.result_list)
+
     def reverse(self):
         self.reversed = not self.reversed
         self.search()
 
-    def search_mechanics(self):
-        db = connect()
+    def toggle_ranked(self):
+        self.ranked = not self.ranked
 
-        self.mechanics_result.clear()
+        self.update_filters_text()
+        self.search()
+
+    # Shows the words that complete the one being typed on the search box
+    def suggest(self):
+        _, prefix = typed_words(self.search_box.get())
+        suggestions = connect().complete_word('games', prefix, SUGGESTIONS) if prefix != None else []
 
-        ids = []
-        for token in tokenize(self.mechanics_search.get()):
-            for mechanic in db.get_by_posting('mechanics', 'word', token):
-                if mechanic['id'] not in ids:
-                    ids.append(mechanic['id'])
-                    item = ListItem(mechanic['id'], mechanic['name'])
-                    self.mechanics_result.add_item(item)
-                    if is_in(self.mechanics, item):
-                        self.mechanics_result.mark_item_as_checked(item)
+        self.search_box.set_title(' '.join(['Search 🔍'] + suggestions))
 
-        if len(self.mechanics_result.get_item_list()) > 0:
-            self.ui.move_focus(self.mechanics_result)
+    def search_mechanics(self, typing=False):
+        self.search_tags('mechanics', self.mechanics_search, self.mechanics_result, self.mechanics, typing)
 
-    def search_categories(self):
+    def search_categories(self, typing=False):
+        self.search_tags('categories', self.categories_search, self.categories_result, self.categories, typing)
+
+    # Lists the mechanics or categories with any of the words on a search
+    # box, checking the selected ones. While `typing`, the last word may be
+    # the start of one, otherwise (on Enter) we move to the list
+    def search_tags(self, document, search_box, result_list, selected, typing):
         db = connect()
 
-        self.categories_result.clear()
+        result_list.clear()
+
+        if typing:
+            words, prefix = typed_words(search_box.get())
+        else:
+            words, prefix = tokenize(search_box.get()), None
 
-        ids = []
-        for token in tokenize(self.categories_search.get()):
-            for category in db.get_by_posting('categories', 'word', token):
-                if category['id'] not in ids:
-                    ids.append(category['id'])
-                    item = ListItem(category['id'], category['name'])
-                    self.categories_result.add_item(item)
-                    if is_in(self.categories, item):
-                        self.categories_result.mark_item_as_checked(item)
+        rows = [db.match_words(document, [word]) for word in words]
+        if prefix != None:
+            rows.append(db.match_prefix(document, prefix))
 
-        if len(self.categories_result.get_item_list()) > 0:
-            self.ui.move_focus(self.categories_result)
+        for tag in db.tables[document].load_many(union_postings(rows), ['id', 'name']):
+            item = ListItem(tag['id'], tag['name'])
+            result_list.add_item(item)
+            if is_in(selected, item):
+                result_list.mark_item_as_checked(item)
+
+        if not typing and len(result_list.get_item_list()) > 0:
+            self.ui.move_focus(result_list)
 
     def update_filters_text(self):
         mechanics = ', '.join(map(str, self.mechanics))
         categories = ', '.join(map(str, self.categories))
+        attributes = ', '.join(f'{column} {op} {value}' for column, op, value in self.conditions)
+
+        order = 'relevance' if self.ranked else 'rating'
+
+        self.current_filter.set_title(f'Mechanics: {mechanics}\nCategories: {categories}\nAttributes: {attributes}\nOrder: {order}')
+
+    def select_filters(self):
+        self.conditions = parse_filters(self.filters_search.get())
 
-        self.current_filter.set_title(f'Mechanics: {mechanics}\nCategories: {categories}')
+        self.update_filters_text()
+        self.search()
 
     def select_category(self):
         category = self.categories_result.get()
@@ -189,7 +246,10 @@ class GameSearchScreen():
         if game == None:
             return
 
-        ui_push(self.ui, gis.GameInfoScreen(self.ui, game.value))
+        # The listing only holds the game's name, load all of it
+        game = connect().get_by_key('games', game.value['id'])
+
+        ui_push(self.ui, gis.GameInfoScreen(self.ui, game))
 
     def apply(self):
         self.ui.set_title('Search Games')
@@ -197,6 +257,43 @@ class GameSearchScreen():
         self.ui.move_focus(self.search_box)
         self.search()
 
+# Turns a string such as "players 3-5 time 60" into conditions on the games'
+# columns. Each filter is a name followed by a number or a range:
+# - players: the game can be played by each of these numbers of players
+# - time: the game's playtime fits in this many minutes (or in this range)
+# - year: the game was published in this year (or range of years)
+# - age: the game is suitable for someone of this age
+# Anything else is ignored
+def parse_filters(string):
+    conditions = []
+    words = string.lower().split()
+
+    for name, value in zip(words, words[1:]):
+        bounds = value.split('-')
+        if len(bounds) > 2 or not all(bound.isdigit() for bound in bounds):
+            continue
+
+        low = int(bounds[0])
+        high = int(bounds[-1])
+
+        if name == 'players':
+            conditions.append(('min_players', '<=', low))
+            conditions.append(('max_players', '>=', high))
+
+        elif name == 'time':
+            if len(bounds) > 1:
+                conditions.append(('min_playtime', '>=', low))
+            conditions.append(('max_playtime', '<=', high))
+
+        elif name == 'year':
+            conditions.append(('year', '>=', low))
+            conditions.append(('year', '<=', high))
+
+        elif name == 'age':
+            conditions.append(('min_age', '<=', high))
+
+    return conditions
+
 def is_in(arr, item):
     for i in arr:
         if i.value == item.value and i.display == item.display:
@@ -2,7 +2,7 @@ import py_cui
 import ui.game_info_screen as gis
 from ui.ui import ui_push
 from db.db import connect
-from utils import game_rating, tokenize, intersect
+from utils import game_rating, tokenize
 from .list_item import ListItem
 
 class PublisherInfoScreen:
@@ -20,9 +20,10 @@ class PublisherInfoScreen:
 
         db = connect()
 
+        game_ids = [game_id for game_id, _ in db.get_by_posting('game_publisher', 'publisher', self.id)]
+
         games = []
-        for game_id, _ in db.get_by_posting('game_publisher', 'publisher', self.id):
-            game = db.get_by_key('games', game_id)
+        for game in db.get_many_by_key('games', game_ids, ['id', 'name']):
             games.append((game, game_rating(game, db)))
 
         games = sorted(games, key=lambda x: x[1], reverse=True)
@@ -37,7 +38,10 @@ class PublisherInfoScreen:
         if game == None:
             return
 
-        ui_push(self.ui, gis.GameInfoScreen(self.ui, game.value))
+        # The listing only holds the game's name, load all of it
+        game = connect().get_by_key('games', game.value['id'])
+
+        ui_push(self.ui, gis.GameInfoScreen(self.ui, game))
 
     def apply(self):
         self.ui.set_title(f"{self.publisher['name']} (#{self.id})")
@@ -2,7 +2,7 @@ import py_cui
 import ui.publisher_info_screen as pis
 from ui.ui import ui_push
 from db.db import connect
-from utils import tokenize, intersect
+from utils import tokenize
 from .list_item import ListItem
 
 class PublisherSearchScreen:
@@ -31,19 +31,19 @@ class PublisherSearchScreen:
             return
 
         db = connect()
-        indexes = None
 
-        for token in tokens:
-            values = db.postings['publishers_word'].get_values(token)
-            if len(values) > 0:
-                indexes = list(intersect(indexes, values))
+        # Every publisher with any of the words, the most relevant first
+        ranked = db.rank_words('publishers', tokens, k=None)
 
-        if indexes == None or len(indexes) <= 0:
+        # Nothing has those words, look for the closest ones instead
+        if len(ranked) <= 0:
+            ranked = db.rank_similar('publishers', tokens, k=None)
+
+        if len(ranked) <= 0:
             return
 
         self.results.clear()
-        for idx in indexes:
-            publisher = db.tables['publishers'].load(idx)
+        for publisher in db.tables['publishers'].load_many([row for row, _ in ranked], ['id', 'name']):
             item = ListItem(publisher, publisher['name'])
             self.results.add_item(item)
 
@@ -55,7 +55,10 @@ class PublisherSearchScreen:
         if publisher == None:
             return
 
-        ui_push(self.ui, pis.PublisherInfoScreen(self.ui, publisher.value))
+        # The listing only holds the publisher's name, load all of it
+        publisher = connect().get_by_key('publishers', publisher.value['id'])
+
+        ui_push(self.ui, pis.PublisherInfoScreen(self.ui, publisher))
 
 
     def apply(self):
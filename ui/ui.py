@@ -20,4 +20,17 @@ def ui_pop(ui):
     screen = __ui_stack[len(__ui_stack) - 1]
     screen.apply()
 
-    ui.lose_focus()
\ No newline at end of file
+    ui.lose_focus()
+
+# Calls command after every key press that changes the text of a text box
+def on_change(text_box, command):
+    handle_key_press = text_box._handle_key_press
+
+    def handle(key_pressed):
+        text = text_box.get()
+        handle_key_press(key_pressed)
+
+        if text_box.get() != text:
+            command()
+
+    text_box._handle_key_press = handle
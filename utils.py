@@ -1,13 +1,12 @@
 import os
 import re
 from stop_words import stop_words
-from functools import reduce
 
 def game_rating(game, db):
     total = 0
     count = 0
 
-    for comment in db.get_by_posting('comments', 'game', game['id']):
+    for comment in db.get_by_posting('comments', 'game', game['id'], ['rating']):
         if comment['rating'] != None:
             total += comment['rating']
             count += 1
@@ -27,25 +26,10 @@ def unique(arr):
             uniq.append(i)
             yield i
 
-def intersect(a, b):
-    if a == None:
-        return b
-
-    if b == None:
-        return a
-
-    return reduce(reduce_intersection, [a, b])
-
 def reduce_extend(a, b):
     a.extend(b)
     return a
 
-def reduce_intersection(a, b):
-    b = list(b)
-    for el in a:
-        if el in b:
-            yield el
-
 def split(arr, length):
     start = 0
     while start < len(arr):
@@ -56,6 +40,27 @@ def openfile(filename):
     return open(filename, 'rb+' if os.path.exists(filename) else 'wb+')
 
 def tokenize(string):
+    return list(unique(words(string)))
+
+# Same as tokenize, keeping repeated words
+def words(string):
+    res = normalize(string).split(' ')
+
+    return list(filter(lambda w: len(w) > 2 and w not in stop_words, res))
+
+# Splits what is being typed into the words already typed, and the last
+# one, which may be the start of a word (None when nothing is being typed)
+def typed_words(string):
+    string = normalize(string)
+    finished, _, last = string.rpartition(' ')
+
+    if last == '':
+        return tokenize(string), None
+
+    return tokenize(finished), last
+
+# Lowercases a string, leaving only letters (without accents) and spaces
+def normalize(string):
     string = string.lower()
 
     # Remove links and newlines
@@ -70,6 +75,4 @@ def tokenize(string):
     string = re.sub('[ñ]', 'n', string)
     string = re.sub('[^a-z ]', '', string)
 
-    res = string.split(' ')
-
-    return list(unique(filter(lambda w: len(w) > 2 and w not in stop_words, res)))
\ No newline at end of file
+    return string